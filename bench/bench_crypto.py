@@ -0,0 +1,102 @@
+#coding: UTF-8
+
+'''Encryption and decryption throughput of SyncwCrypto in MB/s, across
+block sizes, next to the old implementation that created a cipher context
+and two output buffers on every call:
+
+    python bench/bench_crypto.py [--threads N]
+
+'''
+
+import argparse
+import os
+import sys
+import threading
+import time
+from ctypes import create_string_buffer, c_int, byref
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from objectstorage.exceptions import SyncwCryptoException
+from objectstorage.utils.crypto import SyncwCrypto, EVP_CIPHER_CTX_new, EVP_CIPHER_CTX_free, \
+    EVP_aes_256_cbc, EVP_EncryptInit_ex, EVP_EncryptUpdate, EVP_EncryptFinal_ex, \
+    EVP_DecryptInit_ex, EVP_DecryptUpdate, EVP_DecryptFinal_ex
+
+SIZES = [4 * 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+
+class OldSyncwCrypto(object):
+    '''SyncwCrypto before the cipher contexts and output buffers were reused'''
+    def __init__(self, key, iv):
+        self.key = key
+        self.iv = iv
+
+    def enc_data(self, data):
+        return self._run(data, EVP_EncryptInit_ex, EVP_EncryptUpdate, EVP_EncryptFinal_ex)
+
+    def dec_data(self, data):
+        return self._run(data, EVP_DecryptInit_ex, EVP_DecryptUpdate, EVP_DecryptFinal_ex)
+
+    def _run(self, data, init, update, final):
+        ctx = EVP_CIPHER_CTX_new()
+        if not ctx:
+            raise SyncwCryptoException('Failed to create cipher ctx')
+
+        try:
+            if init(ctx, EVP_aes_256_cbc(), None, self.key, self.iv) == 0:
+                raise SyncwCryptoException('Failed to init cipher ctx')
+
+            out = create_string_buffer(len(data) + 16)
+            out_len = c_int(0)
+            if update(ctx, out, byref(out_len), data, len(data)) == 0:
+                raise SyncwCryptoException('Failed to update cipher')
+
+            out_final = create_string_buffer(16)
+            out_final_len = c_int(0)
+            if final(ctx, out_final, byref(out_final_len)) == 0:
+                raise SyncwCryptoException('Failed to finalize cipher')
+
+            return out.raw[:out_len.value] + out_final.raw[:out_final_len.value]
+        finally:
+            EVP_CIPHER_CTX_free(ctx)
+
+def throughput(func, data, n_threads, total_size=128 * 1024 * 1024):
+    '''Best MB/s of 3 runs of func(data) in n_threads threads'''
+    n = max(8, total_size // len(data) // n_threads)
+    def run():
+        for _ in xrange(n):
+            func(data)
+
+    best = 0
+    for _ in range(3):
+        threads = [threading.Thread(target=run) for _ in range(n_threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        best = max(best, n * n_threads * len(data) / (time.time() - start) / 1e6)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    iv = os.urandom(16)
+    print '%10s %12s %12s %12s %12s' % ('size', 'old enc', 'enc', 'old dec', 'dec')
+    for size in SIZES:
+        data = os.urandom(size)
+        results = []
+        for op in ('enc_data', 'dec_data'):
+            old = OldSyncwCrypto(key, iv)
+            new = SyncwCrypto(key, iv)
+            arg = data if op == 'enc_data' else new.enc_data(data)
+            # Both implementations give the same results
+            assert getattr(old, op)(arg) == getattr(new, op)(arg)
+            results.append(throughput(getattr(old, op), arg, args.threads))
+            results.append(throughput(getattr(new, op), arg, args.threads))
+        print '%10d %7.0f MB/s %7.0f MB/s %7.0f MB/s %7.0f MB/s' % tuple([size] + results)
+
+if __name__ == '__main__':
+    main()
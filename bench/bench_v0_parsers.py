@@ -0,0 +1,136 @@
+#coding: UTF-8
+
+'''Parsing speed of version 0 (binary) fs objects, in entries per second,
+next to the old parsers that built struct formats for every entry and hex
+encoded block ids byte by byte:
+
+    python bench/bench_v0_parsers.py [--entries N]
+
+The fs manager is set up with an empty config in a temporary dir.
+
+'''
+
+import argparse
+import binascii
+import os
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from objectstorage.exceptions import ObjectFormatError
+from objectstorage.fs import SyncwDirent, SYNCW_METADATA_TYPE_DIR, SYNCW_METADATA_TYPE_FILE
+
+def old_parse_dirents_v0(data, dir_id):
+    mode, = struct.unpack_from("!i", data, offset = 0)
+    if mode != SYNCW_METADATA_TYPE_DIR:
+        raise ObjectFormatError('corrupt dir object ' + dir_id)
+
+    dirents = {}
+
+    off = 4
+    while True:
+        fmt = "!i40si"
+        mode, eid, name_len = struct.unpack_from(fmt, data, offset=off)
+        off += struct.calcsize(fmt)
+
+        fmt = "!%ds" % name_len
+        name, = struct.unpack_from(fmt, data, offset = off)
+        off += struct.calcsize(fmt)
+
+        if stat.S_ISREG(mode):
+            dirents[name] = SyncwDirent.fromV0(name, SyncwDirent.FILE, eid)
+        elif stat.S_ISDIR(mode):
+            dirents[name] = SyncwDirent.fromV0(name, SyncwDirent.DIR, eid)
+        if off > len(data) - 48:
+            break
+
+    return dirents
+
+def old_parse_blocks_v0(data, obj_id):
+    blocks = []
+
+    fmt = '!iq'
+    mode, size = struct.unpack_from(fmt, data, offset=0)
+    if mode != SYNCW_METADATA_TYPE_FILE:
+        raise ObjectFormatError('corrupt file object ' + obj_id)
+
+    off = struct.calcsize(fmt)
+    while True:
+        fmt = "!20s"
+        bid, = struct.unpack_from(fmt, data, offset = off)
+        hexs = []
+        for d in bid:
+            x = binascii.b2a_hex(d)
+            hexs.append(x)
+
+        blk_id = ''.join(hexs)
+        blocks.append(blk_id)
+
+        off += struct.calcsize(fmt)
+        if off > len(data) - 20:
+            break
+
+    return blocks, size
+
+def make_dir_data(n):
+    parts = [struct.pack('!i', SYNCW_METADATA_TYPE_DIR)]
+    for i in range(n):
+        name = 'entry-%06d' % i
+        mode = stat.S_IFDIR if i % 10 == 0 else stat.S_IFREG | 0644
+        parts.append(struct.pack('!i40si', mode, binascii.b2a_hex(os.urandom(20)), len(name)))
+        parts.append(name)
+    return ''.join(parts)
+
+def make_file_data(n):
+    return struct.pack('!iq', SYNCW_METADATA_TYPE_FILE, 1000 * n) + os.urandom(20 * n)
+
+def best_time(func, *args):
+    best = None
+    for _ in range(5):
+        start = time.time()
+        ret = func(*args)
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return ret, best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    args = parser.parse_args()
+    n = args.entries
+
+    conf_dir = tempfile.mkdtemp()
+    os.environ['SYNCWERK_CONF_DIR'] = conf_dir
+    open(os.path.join(conf_dir, 'server.conf'), 'w').close()
+    try:
+        from objectstorage import fs_mgr
+
+        dir_data = make_dir_data(n)
+        old, old_time = best_time(old_parse_dirents_v0, dir_data, 'dir')
+        new, new_time = best_time(fs_mgr.parse_dirents_v0, dir_data, 'dir')
+        assert sorted((k, d.type, d.id) for k, d in old.iteritems()) == \
+            sorted((k, d.type, d.id) for k, d in new.iteritems())
+        print 'parse_dirents_v0: old %9d entries/s, new %9d entries/s' % (n / old_time,
+                                                                          n / new_time)
+
+        file_data = make_file_data(n)
+        old, old_time = best_time(old_parse_blocks_v0, file_data, 'file')
+        # The block list is decoded lazily, include decoding all the ids
+        def parse_blocks(data, obj_id):
+            blocks, size = fs_mgr.parse_blocks_v0(data, obj_id)
+            return list(blocks), size
+        new, new_time = best_time(parse_blocks, file_data, 'file')
+        assert old == new
+        print 'parse_blocks_v0:  old %9d ids/s,     new %9d ids/s' % (n / old_time,
+                                                                      n / new_time)
+    finally:
+        shutil.rmtree(conf_dir)
+
+if __name__ == '__main__':
+    main()
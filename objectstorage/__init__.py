@@ -2,4 +2,4 @@
 from .commits import commit_mgr
 from .fs import fs_mgr
 from .blocks import block_mgr
-from commit_differ import CommitDiffer
+from commit_differ import CommitDiffer, ChainDiffer
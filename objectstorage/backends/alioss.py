@@ -24,17 +24,59 @@ class SyncwOSSClient(object):
         res = self.bucket.get_object(obj_id)
         return res.read()
 
+    def iter_object_content(self, obj_id, chunk_size):
+        res = self.bucket.get_object(obj_id)
+        while True:
+            data = res.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def read_object_range(self, obj_id, offset, length):
+        try:
+            res = self.bucket.get_object(obj_id, byte_range=(offset, offset + length - 1))
+        except oss2.exceptions.ServerError as e:
+            if e.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                # offset is past the end of the object
+                return ''
+            raise
+
+        data = res.read()
+        if res.status == httplib.OK:
+            # OSS ignores ranges it considers invalid and returns the
+            # whole object.
+            data = data[offset:offset+length]
+        return data
+
+    def get_object_size(self, obj_id):
+        return self.bucket.head_object(obj_id).content_length
+
 class SyncwObjStoreOSS(AbstractObjStore):
     '''OSS backend for syncwerk objects'''
     def __init__(self, compressed, oss_conf, crypto=None):
         AbstractObjStore.__init__(self, compressed, crypto)
         self.oss_client = SyncwOSSClient(oss_conf)
 
+    def reset_clients(self):
+        self.oss_client = SyncwOSSClient(self.oss_client.conf)
+
     def read_obj_raw(self, repo_id, version, obj_id):
         real_obj_id = '%s/%s' % (repo_id, obj_id)
         data = self.oss_client.read_object_content(real_obj_id)
         return data
 
+    def read_obj_raw_chunks(self, repo_id, version, obj_id, chunk_size):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.oss_client.iter_object_content(real_obj_id, chunk_size)
+
+    def read_obj_raw_range(self, repo_id, version, obj_id, offset, length):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.oss_client.read_object_range(real_obj_id, offset, length)
+
+    def stat_obj_raw(self, repo_id, version, obj_id):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.oss_client.get_object_size(real_obj_id)
+
     def get_name(self):
         return 'OSS storage backend'
 
@@ -2,14 +2,101 @@
 
 import zlib
 
+from objectstorage.utils.threads import SharedThreadPool
+
+# Default size of the chunks generated by read_obj_stream()
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def decrypt_chunks(decryptor, chunks):
+    for chunk in chunks:
+        data = decryptor.update(chunk)
+        if data:
+            yield data
+    data = decryptor.final()
+    if data:
+        yield data
+
+def decompress_chunks(chunks, chunk_size):
+    '''Decompress a zlib stream given in chunks, generating chunks of at
+    most chunk_size bytes. Like zlib.decompress, data after the end of the
+    stream is ignored, and a truncated stream raises zlib.error.
+
+    '''
+    d = zlib.decompressobj()
+    for chunk in chunks:
+        # Once the stream has ended, python 2 keeps the remaining input in
+        # unconsumed_tail as well as in unused_data.
+        while chunk and not d.unused_data:
+            data = d.decompress(chunk, chunk_size)
+            if data:
+                yield data
+            chunk = d.unconsumed_tail
+        if d.unused_data:
+            # End of the zlib stream
+            break
+
+    # Output may still be pending after the last input was consumed.
+    while True:
+        data = d.decompress('', chunk_size)
+        if not data:
+            break
+        yield data
+
+    # Decompress objects of python 2 have no eof attribute. Once the stream
+    # has ended, any more input is left in unused_data.
+    if not d.unused_data:
+        try:
+            d.decompress('\0')
+        except zlib.error:
+            pass
+        if d.unused_data != '\0':
+            raise zlib.error('Error -5 while decompressing data: incomplete or truncated stream')
+
 class AbstractObjStore(object):
     '''Base class of syncwerk object backend'''
+    # Max number of concurrent requests made by read_objs()
+    READ_WORKERS = 10
+
     def __init__(self, compressed, crypto=None):
         self.compressed = compressed
         self.crypto = crypto
+        self._read_pool = SharedThreadPool(self.READ_WORKERS)
+
+    def reset_clients(self):
+        '''Drop the connections to the storage, so that new ones are made on
+        next use. Must be called in a forked child process before it reads
+        any object, since connections can't be shared with the parent.
+
+        '''
+        pass
 
     def read_obj(self, repo_id, version, obj_id):
+        # The whole object is needed, it's cheaper to read and decode it at
+        # once than to join the chunks of read_obj_stream().
         data = self.read_obj_raw(repo_id, version, obj_id)
+        return self.decode_obj(version, data)
+
+    def read_obj_stream(self, repo_id, version, obj_id, chunk_size=STREAM_CHUNK_SIZE):
+        '''Generate the content of the object in chunks of at most
+        chunk_size bytes. The raw object is read, decrypted and decompressed
+        piece by piece, so that the whole object never needs to be held in
+        memory in its raw, decrypted and decompressed forms at once.
+
+        '''
+        chunks = self.read_obj_raw_chunks(repo_id, version, obj_id, chunk_size)
+        return self.decode_obj_stream(version, chunks, chunk_size)
+
+    def decode_obj_stream(self, version, chunks, chunk_size=STREAM_CHUNK_SIZE):
+        '''Like decode_obj, for the raw content given as a sequence of chunks'''
+        if self.crypto:
+            chunks = decrypt_chunks(self.crypto.decryptor(), chunks)
+        if self.compressed and version == 1:
+            chunks = decompress_chunks(chunks, chunk_size)
+
+        return chunks
+
+    def decode_obj(self, version, data):
+        '''Decrypt and decompress the raw content of an object'''
         if self.crypto:
             data = self.crypto.dec_data(data)
         if self.compressed and version == 1:
@@ -17,6 +104,94 @@ class AbstractObjStore(object):
 
         return data
 
+    def read_objs(self, repo_id, version, obj_ids, ordered=True):
+        '''Read many objects concurrently. Return an iterator of (obj_id,
+        data) pairs, in the order of obj_ids or, if ordered is False, as
+        soon as each object has been read.
+
+        '''
+        def read(obj_id):
+            return obj_id, self.read_obj(repo_id, version, obj_id)
+        return self._map_concurrent(read, obj_ids, ordered)
+
+    def read_objs_raw(self, repo_id, version, obj_ids, ordered=True):
+        '''Like read_objs, but return the raw content of the objects'''
+        def read(obj_id):
+            return obj_id, self.read_obj_raw(repo_id, version, obj_id)
+        return self._map_concurrent(read, obj_ids, ordered)
+
+    def _map_concurrent(self, func, items, ordered):
+        pool = self._read_pool.get()
+        if ordered:
+            return pool.imap(func, items)
+        else:
+            return pool.imap_unordered(func, items)
+
+    def read_obj_range(self, repo_id, version, obj_id, offset, length):
+        '''Read up to length bytes of the object content, starting at offset.
+        Only the needed part of the object is fetched when the object is not
+        compressed.
+
+        '''
+        if length <= 0:
+            return ''
+        if self.compressed and version == 1:
+            return self.read_obj(repo_id, version, obj_id)[offset:offset+length]
+        if not self.crypto:
+            return self.read_obj_raw_range(repo_id, version, obj_id, offset, length)
+
+        # Objects are encrypted in CBC mode, so a cipher block can be
+        # decrypted with the previous cipher block as iv. We also fetch
+        # one extra block after the range, to know whether the range
+        # reaches the (padded) end of the object.
+        bs = self.crypto.BLOCK_SIZE
+        first = offset // bs
+        last = (offset + length - 1) // bs
+        if first > 0:
+            start = (first - 1) * bs
+        else:
+            start = 0
+        end = (last + 2) * bs
+
+        data = self.read_obj_raw_range(repo_id, version, obj_id, start, end - start)
+        if first > 0:
+            iv = data[:bs]
+            data = data[bs:]
+        else:
+            iv = self.crypto.iv
+        if not data:
+            return ''
+
+        at_end = len(data) < end - first * bs
+        data = self.crypto.dec_blocks(data, iv)
+        if at_end:
+            data = self.crypto.unpad(data)
+        else:
+            data = data[:-bs]
+
+        skip = offset - first * bs
+        return data[skip:skip+length]
+
+    def get_obj_size(self, repo_id, version, obj_id):
+        '''Return the size of the object content as returned by read_obj'''
+        if self.compressed and version == 1:
+            # The stored size doesn't tell the size of the content
+            return sum([len(chunk) for chunk in self.read_obj_stream(repo_id, version, obj_id)])
+
+        size = self.stat_obj_raw(repo_id, version, obj_id)
+        if self.crypto and size > 0:
+            # Only the padding of the last cipher block is unknown
+            bs = self.crypto.BLOCK_SIZE
+            size = size - bs + len(self.read_obj_range(repo_id, version, obj_id, size - bs, bs))
+        return size
+
+    def stat_obj_raw(self, repo_id, version, obj_id):
+        '''Return the size of the raw object in the backend. Backends should
+        override this with a cheap metadata request.
+
+        '''
+        return len(self.read_obj_raw(repo_id, version, obj_id))
+
     def read_obj_raw(self, repo_id, version, obj_id):
         '''Read the raw content of the object from the backend. Each backend
         subclass should have their own implementation.
@@ -24,6 +199,22 @@ class AbstractObjStore(object):
         '''
         raise NotImplementedError
 
+    def read_obj_raw_chunks(self, repo_id, version, obj_id, chunk_size):
+        '''Generate the raw content of the object in chunks of about
+        chunk_size bytes. Backends should override this to stream the
+        object instead of reading it at once.
+
+        '''
+        yield self.read_obj_raw(repo_id, version, obj_id)
+
+    def read_obj_raw_range(self, repo_id, version, obj_id, offset, length):
+        '''Read up to length bytes of the raw object, starting at offset.
+        Return an empty string if offset is past the end of the object.
+        Backends should override this with a ranged request.
+
+        '''
+        return self.read_obj_raw(repo_id, version, obj_id)[offset:offset+length]
+
     def get_name(self):
         '''Get the backend name for display in the log'''
         raise NotImplementedError
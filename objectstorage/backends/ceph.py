@@ -1,4 +1,5 @@
 import Queue
+import errno
 import threading
 
 import rados
@@ -6,6 +7,7 @@ import rados
 from .base import AbstractObjStore
 
 from objectstorage.utils import to_utf8
+from objectstorage.exceptions import GetObjectError
 from objectstorage.utils.ceph_utils import ioctx_set_namespace
 from rados import LIBRADOS_ALL_NSPACES
 
@@ -56,6 +58,9 @@ class IoCtxPool(object):
 
 class SyncwCephClient(object):
     '''Wraps a Ceph ioctx'''
+    # Max number of aio reads in flight in read_objects_content()
+    AIO_WINDOW = 32
+
     def __init__(self, conf):
         self.ioctx_pool = IoCtxPool(conf)
 
@@ -71,16 +76,144 @@ class SyncwCephClient(object):
         finally:
             self.ioctx_pool.return_ioctx(ioctx)
 
+    def iter_object_content(self, repo_id, obj_id, chunk_size):
+        repo_id = to_utf8(repo_id)
+        obj_id = to_utf8(obj_id)
+
+        ioctx = self.ioctx_pool.get_ioctx(repo_id)
+
+        try:
+            size = ioctx.stat(obj_id)[0]
+            offset = 0
+            while offset < size:
+                data = ioctx.read(obj_id, length=min(chunk_size, size - offset), offset=offset)
+                if not data:
+                    break
+                offset += len(data)
+                yield data
+        finally:
+            self.ioctx_pool.return_ioctx(ioctx)
+
+    def read_objects_content(self, repo_id, obj_ids, ordered=True):
+        '''Read many objects of a repo with pipelined aio reads. Yield
+        (obj_id, data) pairs in the order of obj_ids, or as they complete
+        if ordered is False.
+
+        '''
+        repo_id = to_utf8(repo_id)
+        obj_ids = [to_utf8(obj_id) for obj_id in obj_ids]
+
+        ioctx = self.ioctx_pool.get_ioctx(repo_id)
+        completed = Queue.Queue()
+
+        def on_read(idx):
+            def on_complete(completion, data):
+                completed.put((idx, completion.get_return_value(), data))
+            return on_complete
+
+        # The read of an object is issued when its stat completes, so
+        # neither of them blocks the loop below.
+        def on_stat(idx):
+            def on_complete(completion, size, mtime):
+                ret = completion.get_return_value()
+                if ret < 0:
+                    completed.put((idx, ret, None))
+                    return
+                try:
+                    ioctx.aio_read(obj_ids[idx], size, 0, on_read(idx))
+                except rados.Error:
+                    completed.put((idx, -errno.EIO, None))
+            return on_complete
+
+        n_issued = 0
+        n_inflight = 0
+        try:
+            next_idx = 0
+            done = {}
+            while next_idx < len(obj_ids):
+                # Results waiting for their turn count against the window
+                # too, so an ordered read never buffers more than
+                # AIO_WINDOW objects.
+                while n_issued < len(obj_ids) and n_inflight + len(done) < self.AIO_WINDOW:
+                    ioctx.aio_stat(obj_ids[n_issued], on_stat(n_issued))
+                    n_issued += 1
+                    n_inflight += 1
+
+                idx, ret, data = completed.get()
+                n_inflight -= 1
+                if ret < 0:
+                    raise GetObjectError('[ceph] Failed to read %s: %d' % (obj_ids[idx], ret))
+
+                if ordered:
+                    done[idx] = data
+                    while next_idx in done:
+                        yield obj_ids[next_idx], done.pop(next_idx)
+                        next_idx += 1
+                else:
+                    next_idx += 1
+                    yield obj_ids[idx], data
+        finally:
+            # The ioctx can't be reused before all its requests are
+            # finished. Each object issued reports exactly one result.
+            while n_inflight > 0:
+                completed.get()
+                n_inflight -= 1
+            self.ioctx_pool.return_ioctx(ioctx)
+
+    def read_object_range(self, repo_id, obj_id, offset, length):
+        repo_id = to_utf8(repo_id)
+        obj_id = to_utf8(obj_id)
+
+        ioctx = self.ioctx_pool.get_ioctx(repo_id)
+
+        try:
+            return ioctx.read(obj_id, length=length, offset=offset)
+        finally:
+            self.ioctx_pool.return_ioctx(ioctx)
+
+    def get_object_size(self, repo_id, obj_id):
+        repo_id = to_utf8(repo_id)
+        obj_id = to_utf8(obj_id)
+
+        ioctx = self.ioctx_pool.get_ioctx(repo_id)
+
+        try:
+            return ioctx.stat(obj_id)[0]
+        finally:
+            self.ioctx_pool.return_ioctx(ioctx)
+
 class SyncwObjStoreCeph(AbstractObjStore):
     '''Ceph backend for syncwerk objects'''
     def __init__(self, compressed, ceph_conf, crypto=None):
         AbstractObjStore.__init__(self, compressed, crypto)
+        self.ceph_conf = ceph_conf
         self.ceph_client = SyncwCephClient(ceph_conf)
 
+    def reset_clients(self):
+        # The rados handle of the parent process can't be used, nor safely
+        # shut down, in a child process.
+        self.ceph_client = SyncwCephClient(self.ceph_conf)
+
     def read_obj_raw(self, repo_id, version, obj_id):
         data = self.ceph_client.read_object_content(repo_id, obj_id)
         return data
 
+    def read_objs_raw(self, repo_id, version, obj_ids, ordered=True):
+        return self.ceph_client.read_objects_content(repo_id, obj_ids, ordered)
+
+    def read_objs(self, repo_id, version, obj_ids, ordered=True):
+        for obj_id, data in self.read_objs_raw(repo_id, version, obj_ids, ordered):
+            yield obj_id, self.decode_obj(version, data)
+
+    def read_obj_raw_chunks(self, repo_id, version, obj_id, chunk_size):
+        return self.ceph_client.iter_object_content(repo_id, obj_id, chunk_size)
+
+    def read_obj_raw_range(self, repo_id, version, obj_id, offset, length):
+        return self.ceph_client.read_object_range(repo_id, obj_id, offset, length)
+
+    def stat_obj_raw(self, repo_id, version, obj_id):
+        return self.ceph_client.get_object_size(repo_id, obj_id)
+
     def get_name(self):
         return 'Ceph storage backend'
 
@@ -21,7 +21,30 @@ class SyncwObjStoreFS(AbstractObjStore):
             data = fp.read()
             
         return data
-        
+
+    def read_obj_raw_chunks(self, repo_id, version, obj_id, chunk_size):
+        path = id_to_path(os.path.join(self.obj_dir, repo_id), obj_id)
+
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(chunk_size)
+                if not data:
+                    break
+                yield data
+
+    def read_obj_raw_range(self, repo_id, version, obj_id, offset, length):
+        path = id_to_path(os.path.join(self.obj_dir, repo_id), obj_id)
+
+        with open(path, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+
+        return data
+
+    def stat_obj_raw(self, repo_id, version, obj_id):
+        path = id_to_path(os.path.join(self.obj_dir, repo_id), obj_id)
+        return os.path.getsize(path)
+
     def get_name(self):
         return 'filesystem storage backend'
 
@@ -1,8 +1,13 @@
 from .base import AbstractObjStore
+from objectstorage.exceptions import GetObjectError
+
+import httplib
+import threading
 
 import boto
 import boto.s3.connection
 from boto.s3.key import Key
+from boto.exception import S3ResponseError
 
 class S3Conf(object):
     def __init__(self, key_id, key, bucket_name, host, port, use_v4_sig, aws_region):
@@ -55,17 +60,84 @@ class SyncwS3Client(object):
 
         return k.get_contents_as_string()
 
+    def iter_object_content(self, obj_id, chunk_size):
+        if not self.conn:
+            self.do_connect()
+
+        k = Key(bucket=self.bucket, name=obj_id)
+        k.open_read()
+        try:
+            while True:
+                data = k.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            k.close()
+
+    def read_object_range(self, obj_id, offset, length):
+        if not self.conn:
+            self.do_connect()
+
+        k = Key(bucket=self.bucket, name=obj_id)
+        hdr = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        try:
+            return k.get_contents_as_string(headers=hdr)
+        except S3ResponseError as e:
+            if e.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                # offset is past the end of the object
+                return ''
+            raise
+
+    def get_object_size(self, obj_id):
+        if not self.conn:
+            self.do_connect()
+
+        k = self.bucket.get_key(obj_id)
+        if k is None:
+            raise GetObjectError('[s3] Object %s not found' % obj_id)
+
+        return k.size
+
 class SyncwObjStoreS3(AbstractObjStore):
     '''S3 backend for syncwerk objecs'''
     def __init__(self, compressed, s3_conf, crypto=None):
         AbstractObjStore.__init__(self, compressed, crypto)
-        self.s3_client = SyncwS3Client(s3_conf)
+        self.s3_conf = s3_conf
+        self._local = threading.local()
+
+    @property
+    def s3_client(self):
+        '''boto connections can't be shared between threads, so each thread
+        (e.g. the read_objs() workers) gets its own client.
+
+        '''
+        client = getattr(self._local, 's3_client', None)
+        if client is None:
+            client = SyncwS3Client(self.s3_conf)
+            self._local.s3_client = client
+        return client
+
+    def reset_clients(self):
+        self._local = threading.local()
 
     def read_obj_raw(self, repo_id, version, obj_id):
         real_obj_id = '%s/%s' % (repo_id, obj_id)
         data = self.s3_client.read_object_content(real_obj_id)
         return data
 
+    def read_obj_raw_chunks(self, repo_id, version, obj_id, chunk_size):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.s3_client.iter_object_content(real_obj_id, chunk_size)
+
+    def read_obj_raw_range(self, repo_id, version, obj_id, offset, length):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.s3_client.read_object_range(real_obj_id, offset, length)
+
+    def stat_obj_raw(self, repo_id, version, obj_id):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.s3_client.get_object_size(real_obj_id)
+
     def get_name(self):
         return 'S3 storage backend'
 
@@ -3,6 +3,7 @@
 import httplib
 import urllib2
 import json
+import threading
 from objectstorage.backends.base import AbstractObjStore
 from objectstorage.exceptions import GetObjectError, SwiftAuthenticateError
 
@@ -19,12 +20,18 @@ class SwiftConf(object):
         self.domain = domain
 
 class SyncwSwiftClient(object):
+    '''A client of the swift API. It can be used from several threads: the
+    token and storage url are only set and reset under the auth lock, and
+    the requests use a consistent pair of them.
+
+    '''
     MAX_RETRY = 2
 
     def __init__(self, swift_conf):
         self.swift_conf = swift_conf
         self.token = None
         self.storage_url = None
+        self.auth_lock = threading.Lock()
         if swift_conf.use_https:
             self.base_url = 'https://%s' % swift_conf.auth_host
         else:
@@ -35,6 +42,29 @@ class SyncwSwiftClient(object):
             return True
         return False
 
+    def get_auth(self):
+        '''Return the (storage_url, token) to use, after authenticating if
+        needed. Only one thread authenticates at a time, the others wait for
+        its result.
+
+        '''
+        with self.auth_lock:
+            if not self.authenticated():
+                self.authenticate()
+                if not self.authenticated():
+                    raise SwiftAuthenticateError('[swift] Failed to authenticate: no token or storage url.')
+            return self.storage_url, self.token
+
+    def reset_auth(self, token):
+        '''Forget the token after it was rejected, unless another thread has
+        already replaced it.
+
+        '''
+        with self.auth_lock:
+            if self.token == token:
+                self.token = None
+                self.storage_url = None
+
     def authenticate(self):
         if self.swift_conf.auth_ver == 'v1.0':
             self.authenticate_v1()
@@ -158,51 +188,127 @@ class SyncwSwiftClient(object):
         if self.swift_conf.region and self.storage_url == None:
             raise SwiftAuthenticateError('[swift] Region \'%s\' not found.' % self.swift_conf.region)
 
-    def read_object_content(self, obj_id):
+    def _open_object(self, obj_id, byte_range=None):
+        '''Send the GET request for the object, or only the (offset, length)
+        byte_range of it. Return the response, or None if the range is past
+        the end of the object.
+
+        '''
         i = 0
         while i <= SyncwSwiftClient.MAX_RETRY:
-            if not self.authenticated():
-                self.authenticate()
+            storage_url, token = self.get_auth()
 
-            url = '%s/%s/%s' % (self.storage_url, self.swift_conf.container, obj_id)
-            hdr = {'X-Auth-Token': self.token}
+            url = '%s/%s/%s' % (storage_url, self.swift_conf.container, obj_id)
+            hdr = {'X-Auth-Token': token}
+            if byte_range:
+                offset, length = byte_range
+                hdr['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
             req = urllib2.Request(url, headers=hdr)
             try:
                 resp = urllib2.urlopen(req)
             except urllib2.HTTPError as e:
                 err_code = e.getcode()
                 if err_code == httplib.UNAUTHORIZED:
-                    # Reset token and storage_url
-                    self.token = None
-                    self.storage_url = None
+                    self.reset_auth(token)
                     i += 1
                     continue
+                elif err_code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE and byte_range:
+                    # offset is past the end of the object
+                    return None
                 else:
                     raise GetObjectError('[swift] Failed to read %s: %d' % (obj_id, err_code))
             except urllib2.URLError as e:
                 raise GetObjectError('[swift] Failed to read %s: %s' % (obj_id, e.reason))
 
             ret_code = resp.getcode()
-            ret_data = resp.read()
-
-            if ret_code == httplib.OK:
-                return ret_data
+            if ret_code == httplib.OK or (ret_code == httplib.PARTIAL_CONTENT and byte_range):
+                return resp
             else:
                 raise GetObjectError('[swift] Unexpected code when read %s: %d' %
                                      (obj_id, ret_code))
         raise GetObjectError('[swift] Failed to read %s: quit after %d unauthorized retries.',
                              SyncwSwiftClient.MAX_RETRY)
 
+    def read_object_content(self, obj_id, byte_range=None):
+        '''Read the object, or only the (offset, length) byte_range of it'''
+        resp = self._open_object(obj_id, byte_range)
+        if resp is None:
+            return ''
+
+        ret_data = resp.read()
+        if resp.getcode() == httplib.OK and byte_range:
+            # The server ignored the range
+            offset, length = byte_range
+            return ret_data[offset:offset+length]
+        return ret_data
+
+    def iter_object_content(self, obj_id, chunk_size):
+        resp = self._open_object(obj_id)
+        try:
+            while True:
+                data = resp.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            resp.close()
+
+    def get_object_size(self, obj_id):
+        i = 0
+        while i <= SyncwSwiftClient.MAX_RETRY:
+            storage_url, token = self.get_auth()
+
+            url = '%s/%s/%s' % (storage_url, self.swift_conf.container, obj_id)
+            hdr = {'X-Auth-Token': token}
+            req = urllib2.Request(url, headers=hdr)
+            req.get_method = lambda: 'HEAD'
+            try:
+                resp = urllib2.urlopen(req)
+            except urllib2.HTTPError as e:
+                err_code = e.getcode()
+                if err_code == httplib.UNAUTHORIZED:
+                    self.reset_auth(token)
+                    i += 1
+                    continue
+                else:
+                    raise GetObjectError('[swift] Failed to stat %s: %d' % (obj_id, err_code))
+            except urllib2.URLError as e:
+                raise GetObjectError('[swift] Failed to stat %s: %s' % (obj_id, e.reason))
+
+            ret_code = resp.getcode()
+            if ret_code == httplib.OK:
+                return int(resp.headers['content-length'])
+            else:
+                raise GetObjectError('[swift] Unexpected code when stat %s: %d' %
+                                     (obj_id, ret_code))
+        raise GetObjectError('[swift] Failed to stat %s: quit after %d unauthorized retries.' %
+                             (obj_id, SyncwSwiftClient.MAX_RETRY))
+
 class SyncwObjStoreSwift(AbstractObjStore):
     '''Swift backend for syncwerk objecs'''
     def __init__(self, compressed, swift_conf, crypto=None):
         AbstractObjStore.__init__(self, compressed, crypto)
         self.swift_client = SyncwSwiftClient(swift_conf)
 
+    def reset_clients(self):
+        self.swift_client = SyncwSwiftClient(self.swift_client.swift_conf)
+
     def read_obj_raw(self, repo_id, version, obj_id):
         real_obj_id = '%s/%s' % (repo_id, obj_id)
         data = self.swift_client.read_object_content(real_obj_id)
         return data
 
+    def read_obj_raw_chunks(self, repo_id, version, obj_id, chunk_size):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.swift_client.iter_object_content(real_obj_id, chunk_size)
+
+    def read_obj_raw_range(self, repo_id, version, obj_id, offset, length):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.swift_client.read_object_content(real_obj_id, (offset, length))
+
+    def stat_obj_raw(self, repo_id, version, obj_id):
+        real_obj_id = '%s/%s' % (repo_id, obj_id)
+        return self.swift_client.get_object_size(real_obj_id)
+
     def get_name(self):
         return 'Swift storage backend'
@@ -1,28 +1,103 @@
 from .objstore_factory import objstore_factory
 from .objstore_factory import get_repo_storage_id
+from objectstorage.utils.cache import TinyLFUCache
+from objectstorage.utils.lazy import LazyObject
 
 class SyncwBlockManager(object):
     def __init__(self):
-        if not objstore_factory.enable_storage_classes:
+        self._storage_classes = objstore_factory.enable_storage_classes
+        if not self._storage_classes:
             self.obj_store = objstore_factory.get_obj_store('blocks')
         else:
             self.obj_stores = objstore_factory.get_obj_stores('blocks')
         self._counter = 0
 
+        # Blocks are immutable by id, so cached blocks never need to be
+        # invalidated.
+        cache_size = objstore_factory.get_cache_size('blocks')
+        if cache_size > 0:
+            self._cache = TinyLFUCache(cache_size)
+        else:
+            self._cache = None
+
     def read_count(self):
         return self._counter
 
+    def cache_hit_count(self):
+        return self._cache.hit_count() if self._cache is not None else 0
+    def cache_miss_count(self):
+        return self._cache.miss_count() if self._cache is not None else 0
+    def cache_evict_count(self):
+        return self._cache.evict_count() if self._cache is not None else 0
+
+    def _get_obj_store(self, repo_id):
+        if not self._storage_classes:
+            return self.obj_store
+
+        storage_id = get_repo_storage_id(repo_id)
+        if storage_id:
+            return self.obj_stores[storage_id]
+        else:
+            return self.obj_stores['__default__']
+
     def load_block(self, repo_id, version, obj_id):
         self._counter += 1
-        if not objstore_factory.enable_storage_classes:
-            data = self.obj_store.read_obj(repo_id, version, obj_id)
-        else:
-            storage_id = get_repo_storage_id(repo_id)
-            if storage_id:
-                data = self.obj_stores[storage_id].read_obj(repo_id, version, obj_id)
-            else:
-                data = self.obj_stores['__default__'].read_obj(repo_id, version, obj_id)
+
+        if self._cache is None:
+            return self._get_obj_store(repo_id).read_obj(repo_id, version, obj_id)
+
+        # Key on the repo too, so a block is only served from the cache to
+        # repos that actually contain it.
+        key = (repo_id, obj_id)
+        data = self._cache.get(key)
+        if data is None:
+            data = self._get_obj_store(repo_id).read_obj(repo_id, version, obj_id)
+            self._cache.put(key, data)
         return data
 
+    def load_blocks(self, repo_id, version, block_ids):
+        '''Load many blocks at once, reading them concurrently. Return the
+        blocks content in the order of block_ids.
+
+        '''
+        self._counter += len(block_ids)
+
+        blocks = {}
+        to_read = []
+        for block_id in block_ids:
+            if block_id in blocks:
+                continue
+            if self._cache is not None:
+                data = self._cache.get((repo_id, block_id))
+                if data is not None:
+                    blocks[block_id] = data
+                    continue
+            blocks[block_id] = None
+            to_read.append(block_id)
+
+        if to_read:
+            obj_store = self._get_obj_store(repo_id)
+            for block_id, data in obj_store.read_objs(repo_id, version, to_read, ordered=False):
+                if self._cache is not None:
+                    self._cache.put((repo_id, block_id), data)
+                blocks[block_id] = data
+
+        return [blocks[block_id] for block_id in block_ids]
+
+    def load_block_range(self, repo_id, version, obj_id, offset, length):
+        '''Load up to length bytes of a block, starting at offset'''
+        self._counter += 1
+
+        if self._cache is not None and (repo_id, obj_id) in self._cache:
+            data = self._cache.get((repo_id, obj_id))
+            if data is not None:
+                return data[offset:offset+length]
+
+        return self._get_obj_store(repo_id).read_obj_range(repo_id, version, obj_id, offset, length)
+
+    def stat_block(self, repo_id, version, obj_id):
+        '''Return the size of a block without downloading it'''
+        return self._get_obj_store(repo_id).get_obj_size(repo_id, version, obj_id)
+
 
-block_mgr = SyncwBlockManager()
+block_mgr = LazyObject(SyncwBlockManager)
@@ -1,10 +1,35 @@
 # coding: UTF-8
 
 from objectstorage import fs_mgr
+from objectstorage.objstore_factory import objstore_factory
+from objectstorage.fs import SyncwDirent
+from objectstorage.utils import to_utf8
+from objectstorage.utils.cache import LRUCache
+from objectstorage.utils.threads import SharedThreadPool
 import os
+import logging
+import threading
+import traceback
+import multiprocessing
 
 ZERO_OBJ_ID = '0000000000000000000000000000000000000000'
 
+# Steps of a ChainDiffer are computed in these threads, so that the dirs of
+# the next step are loaded while the previous step is being consumed.
+CHAIN_DIFF_THREADS = 4
+chain_diff_pool = SharedThreadPool(CHAIN_DIFF_THREADS)
+
+# Kinds of changes generated by CommitDiffer.iter_diff()
+ADDED_FILE = 'added_file'
+DELETED_FILE = 'deleted_file'
+MODIFIED_FILE = 'modified_file'
+ADDED_DIR = 'added_dir'
+DELETED_DIR = 'deleted_dir'
+RENAMED_FILE = 'renamed_file'
+MOVED_FILE = 'moved_file'
+RENAMED_DIR = 'renamed_dir'
+MOVED_DIR = 'moved_dir'
+
 
 class DiffEntry(object):
     def __init__(self, path, obj_id, size=-1, new_path=None):
@@ -13,14 +38,195 @@ class DiffEntry(object):
         self.obj_id = obj_id
         self.size = size
 
+# Rough memory cost of a cached change besides its path: the tuple, the
+# obj_id string and the size.
+CACHED_CHANGE_OVERHEAD = 240
+
+def _cached_changes_size(changes):
+    return sum([len(c[1]) for c in changes]) + len(changes) * CACHED_CHANGE_OVERHEAD
+
+class SubtreeDiffCache(LRUCache):
+    '''Cache of the changes between two versions of a dir, keyed by the
+    (old_dir_id, new_dir_id, fold_dirs) of the diff. Dir ids are content
+    hashes, so a cached result never becomes stale and can be shared by all
+    CommitDiffers, whatever the path of the dir in their trees.
+
+    The changes are stored as (change, path, obj_id, size) tuples with paths
+    relative to the dir. The cache is bounded by max_bytes, the estimated
+    memory used by the cached changes.
+
+    '''
+    def __init__(self, max_bytes):
+        LRUCache.__init__(self, max_bytes, sizeof=_cached_changes_size)
+
 class CommitDiffer(object):
-    def __init__(self, repo_id, version, root1, root2, handle_rename=False, fold_dirs=False):
+    '''Compute the changes between two root dirs.
+
+    If parallel is True, the dirs of each level of the changed trees are
+    read concurrently in batches of at most batch_size dirs, instead of
+    one after another. The result of diff() is the same in both modes.
+
+    paths can be a list of paths (e.g. ['/docs/2018']) to only diff the
+    changes under these paths instead of the whole tree.
+
+    diff_cache can be a SubtreeDiffCache shared between differs. The changed
+    dirs are then diffed depth first, and the diff of each changed dir pair
+    is looked up in, or added to, the cache instead of walked again.
+
+    '''
+    def __init__(self, repo_id, version, root1, root2, handle_rename=False, fold_dirs=False,
+                 parallel=False, batch_size=500, paths=None, diff_cache=None):
         self.repo_id = repo_id
         self.version = version
         self.root1 = root1
         self.root2 = root2
         self.handle_rename = handle_rename
         self.fold_dirs = fold_dirs
+        self.parallel = parallel
+        self.batch_size = batch_size
+        self.paths = normalize_paths(paths)
+        self.diff_cache = diff_cache
+
+    def _diff_dirs(self, path, dir1, dir2, queued_dirs, new_dirs, del_dirs):
+        '''Compare two versions of the dir at path by merging their dirents
+        in name order. The dirs are not modified, and an unchanged entry
+        only costs a couple of comparisons.
+
+        '''
+        ents1 = dir1.get_sorted_dirents()
+        ents2 = dir2.get_sorted_dirents()
+        n1 = len(ents1)
+        n2 = len(ents2)
+        i = j = 0
+        while i < n1 and j < n2:
+            dent1 = ents1[i]
+            dent2 = ents2[j]
+            if dent1.name == dent2.name:
+                i += 1
+                j += 1
+                if dent1.raw_id == dent2.raw_id and dent1.type == dent2.type:
+                    continue
+            elif dent1.name < dent2.name:
+                i += 1
+                dent2 = None
+            else:
+                j += 1
+                dent1 = None
+
+            for change in self._diff_dents(make_path(path, (dent1 or dent2).name), dent1, dent2,
+                                           queued_dirs, new_dirs, del_dirs):
+                yield change
+
+        for dent1 in ents1[i:]:
+            for change in self._diff_dents(make_path(path, dent1.name), dent1, None,
+                                           queued_dirs, new_dirs, del_dirs):
+                yield change
+        for dent2 in ents2[j:]:
+            for change in self._diff_dents(make_path(path, dent2.name), None, dent2,
+                                           queued_dirs, new_dirs, del_dirs):
+                yield change
+
+    def _diff_dents(self, path, dent1, dent2, queued_dirs, new_dirs, del_dirs):
+        '''Compare the old and new dirent at path, either of which may be
+        None. Changed dirs are added to queued_dirs. Added and deleted dirs
+        are generated if fold_dirs is set, or else added to new_dirs and
+        del_dirs to be expanded later.
+
+        '''
+        if dent1 is not None and dent2 is not None and dent1.type == dent2.type:
+            if dent1.raw_id == dent2.raw_id:
+                pass
+            elif dent1.is_dir():
+                queued_dirs.append((path, dent1.id, dent2.id))
+            else:
+                yield MODIFIED_FILE, DiffEntry(path, dent2.id, dent2.size)
+            return
+
+        if dent1 is not None:
+            if dent1.is_file():
+                yield DELETED_FILE, DiffEntry(path, dent1.id, dent1.size)
+            elif self.fold_dirs:
+                yield DELETED_DIR, DiffEntry(path, dent1.id)
+            else:
+                del_dirs.append(DiffEntry(path, dent1.id))
+
+        if dent2 is not None:
+            if dent2.is_file():
+                yield ADDED_FILE, DiffEntry(path, dent2.id, dent2.size)
+            elif self.fold_dirs:
+                yield ADDED_DIR, DiffEntry(path, dent2.id)
+            else:
+                new_dirs.append(DiffEntry(path, dent2.id))
+
+    def _get_scopes(self):
+        '''Return the (path, old_dent, new_dent) entries to start the diff
+        from. A dent is None if the path doesn't exist in that root.
+
+        '''
+        root1 = SyncwDirent('', SyncwDirent.DIR, self.root1, -1, -1)
+        root2 = SyncwDirent('', SyncwDirent.DIR, self.root2, -1, -1)
+        if not self.paths:
+            return [('/', root1, root2)]
+
+        return [(path, ) + self._resolve_path(path, root1, root2) for path in self.paths]
+
+    def _resolve_path(self, path, old_dent, new_dent):
+        '''Look up path in both trees at once, starting from the old_dent and
+        new_dent root dirs. Return the (old_dent, new_dent) of path.
+
+        '''
+        for name in path.strip('/').split('/'):
+            if old_dent and new_dent and old_dent.is_dir() and \
+               new_dent.is_dir() and old_dent.raw_id == new_dent.raw_id:
+                # Nothing changed under this dir, no need to go further
+                return old_dent, old_dent
+            old_dent = self._lookup_dent(old_dent, name)
+            new_dent = self._lookup_dent(new_dent, name)
+            if not old_dent and not new_dent:
+                break
+
+        return old_dent, new_dent
+
+    def _lookup_dent(self, dir_dent, name):
+        if not dir_dent or not dir_dent.is_dir():
+            return None
+        return self._load_dir(dir_dent.id).lookup_dent(name)
+
+    def _load_dir(self, dir_id):
+        return fs_mgr.load_syncwdir(self.repo_id, self.version, dir_id)
+
+    def _load_dir_list(self, dir_ids):
+        return fs_mgr.load_syncwdirs(self.repo_id, self.version, dir_ids)
+
+    def _load_dir_pairs(self, level):
+        '''Yield (path, dir1, dir2) for each (path, dir_id1, dir_id2) of level'''
+        if not self.parallel:
+            for path, old_id, new_id in level:
+                yield path, self._load_dir(old_id), self._load_dir(new_id)
+            return
+
+        for i in xrange(0, len(level), self.batch_size):
+            batch = level[i:i+self.batch_size]
+            dir_ids = []
+            for _, old_id, new_id in batch:
+                dir_ids.append(old_id)
+                dir_ids.append(new_id)
+            dirs = self._load_dir_list(dir_ids)
+            for j, (path, _, _) in enumerate(batch):
+                yield path, dirs[2*j], dirs[2*j+1]
+
+    def _load_dirs(self, level):
+        '''Yield (item, dir) for each (dir_dent, ...) item of level'''
+        if not self.parallel:
+            for item in level:
+                yield item, self._load_dir(item[0].obj_id)
+            return
+
+        for i in xrange(0, len(level), self.batch_size):
+            batch = level[i:i+self.batch_size]
+            dirs = self._load_dir_list([item[0].obj_id for item in batch])
+            for item, d in zip(batch, dirs):
+                yield item, d
 
     def diff_to_unicode(self):
         # you can also do this by overwriting key points
@@ -46,138 +252,341 @@ class CommitDiffer(object):
         moved_files = []
         moved_dirs = []
 
+        lists = {
+            ADDED_FILE: added_files,
+            DELETED_FILE: deleted_files,
+            MODIFIED_FILE: modified_files,
+            ADDED_DIR: added_dirs,
+            DELETED_DIR: deleted_dirs,
+            RENAMED_FILE: renamed_files,
+            MOVED_FILE: moved_files,
+            RENAMED_DIR: renamed_dirs,
+            MOVED_DIR: moved_dirs,
+        }
+        for change, entry in self.iter_diff():
+            lists[change].append(entry)
+
+        return (added_files, deleted_files, added_dirs, deleted_dirs,
+                modified_files, renamed_files, moved_files,
+                renamed_dirs, moved_dirs)
+
+    def iter_diff(self):
+        '''Generate the changes as (change, DiffEntry) pairs, where change is
+        one of ADDED_FILE, DELETED_FILE, MODIFIED_FILE, ADDED_DIR or
+        DELETED_DIR, and, if handle_rename is set, RENAMED_FILE, MOVED_FILE,
+        RENAMED_DIR or MOVED_DIR.
+
+        Changes are generated as soon as each dir pair is compared, so only
+        the dirs queued for the next level are kept in memory. Rename
+        detection has to buffer the added and deleted entries until the end.
+
+        '''
+        changes = self._walk()
+        if self.handle_rename:
+            changes = detect_renames(changes)
+        return changes
+
+    def _walk(self):
         new_dirs = []
         del_dirs = []
         queued_dirs = [] # (path, dir_id1, dir_id2)
 
         if self.root1 == self.root2:
-            return (added_files, deleted_files, added_dirs, deleted_dirs,
-                    modified_files, renamed_files, moved_files,
-                    renamed_dirs, moved_dirs)
-        else:
-            queued_dirs.append(('/', self.root1, self.root2))
+            return
 
-        while True:
-            path = old_id = new_id = None
-            try:
-                path, old_id, new_id = queued_dirs.pop(0)
-            except IndexError:
-                break
+        for path, old_dent, new_dent in self._get_scopes():
+            for change in self._diff_dents(path, old_dent, new_dent, queued_dirs, new_dirs, del_dirs):
+                yield change
 
-            dir1 = fs_mgr.load_syncwdir(self.repo_id, self.version, old_id)
-            dir2 = fs_mgr.load_syncwdir(self.repo_id, self.version, new_id)
+        if self.diff_cache is not None:
+            for path, old_id, new_id in queued_dirs:
+                for change, sub_path, obj_id, size in self._diff_subtree(old_id, new_id):
+                    yield change, DiffEntry(join_path(path, sub_path), obj_id, size)
+            queued_dirs = []
 
-            for dent in dir1.get_files_list():
-                new_dent = dir2.lookup_dent(dent.name)
-                if not new_dent or new_dent.type != dent.type:
-                    deleted_files.append(DiffEntry(make_path(path, dent.name), dent.id, dent.size))
-                else:
-                    dir2.remove_entry(dent.name)
-                    if new_dent.id == dent.id:
-                        pass
-                    else:
-                        modified_files.append(DiffEntry(make_path(path, dent.name), new_dent.id, new_dent.size))
-
-            added_files.extend([DiffEntry(make_path(path, dent.name), dent.id, dent.size) for dent in dir2.get_files_list()])
-
-            for dent in dir1.get_subdirs_list():
-                new_dent = dir2.lookup_dent(dent.name)
-                if not new_dent or new_dent.type != dent.type:
-                    del_dirs.append(DiffEntry(make_path(path, dent.name), dent.id))
+        # Walk the changed dirs breadth first, one level at a time, so that
+        # all the dirs of a level can be loaded in one batch.
+        while queued_dirs:
+            level = queued_dirs
+            queued_dirs = []
+            for path, dir1, dir2 in self._load_dir_pairs(level):
+                for change in self._diff_dirs(path, dir1, dir2, queued_dirs, new_dirs, del_dirs):
+                    yield change
+
+        if not self.fold_dirs:
+            for change in self._expand_dirs(new_dirs, del_dirs):
+                yield change
+
+    def _expand_dirs(self, new_dirs, del_dirs):
+        '''Process newly added and deleted dirs and their sub-dirs, all
+        files under these dirs are marked as added or deleted. The added and
+        deleted subtrees are loaded together, level by level.
+
+        '''
+        level = [(dir_dent, True) for dir_dent in new_dirs] + \
+                [(dir_dent, False) for dir_dent in del_dirs]
+        while level:
+            next_level = []
+            for (dir_dent, added), d in self._load_dirs(level):
+                if added:
+                    dir_change, file_change = ADDED_DIR, ADDED_FILE
                 else:
-                    dir2.remove_entry(dent.name)
-                    if new_dent.id == dent.id:
-                        pass
-                    else:
-                        queued_dirs.append((make_path(path, dent.name), dent.id, new_dent.id))
+                    dir_change, file_change = DELETED_DIR, DELETED_FILE
+                yield dir_change, dir_dent
+                for dent in d.get_files_list():
+                    yield file_change, DiffEntry(make_path(dir_dent.path, dent.name), dent.id, dent.size)
 
-            new_dirs.extend([DiffEntry(make_path(path, dent.name), dent.id) for dent in dir2.get_subdirs_list()])
+                next_level.extend([(DiffEntry(make_path(dir_dent.path, dent.name), dent.id), added) \
+                                   for dent in d.get_subdirs_list()])
+            level = next_level
 
+    def _diff_subtree(self, old_id, new_id):
+        '''Return the changes between the dirs old_id and new_id, with paths
+        relative to them, from diff_cache if possible. The changed sub-dirs
+        are diffed recursively, so that their results are cached too.
+
+        '''
+        key = (old_id, new_id, self.fold_dirs)
+        changes = self.diff_cache.get(key)
+        if changes is not None:
+            return changes
+
+        dir1 = self._load_dir(old_id)
+        dir2 = self._load_dir(new_id)
+        queued_dirs = []
+        new_dirs = []
+        del_dirs = []
+        changes = [(change, entry.path, entry.obj_id, entry.size) for change, entry in \
+                   self._diff_dirs('/', dir1, dir2, queued_dirs, new_dirs, del_dirs)]
+        for path, sub_old_id, sub_new_id in queued_dirs:
+            changes.extend([(change, join_path(path, sub_path), obj_id, size) for change, sub_path, obj_id, size in \
+                            self._diff_subtree(sub_old_id, sub_new_id)])
         if not self.fold_dirs:
-            while True:
-                # Process newly added dirs and its sub-dirs, all files under
-                # these dirs should be marked as added.
-                try:
-                    dir_dent = new_dirs.pop(0)
-                    added_dirs.append(DiffEntry(dir_dent.path, dir_dent.obj_id))
-                except IndexError:
-                    break
-                d = fs_mgr.load_syncwdir(self.repo_id, self.version, dir_dent.obj_id)
-                added_files.extend([DiffEntry(make_path(dir_dent.path, dent.name), dent.id, dent.size) for dent in d.get_files_list()])
-
-                new_dirs.extend([DiffEntry(make_path(dir_dent.path, dent.name), dent.id) for dent in d.get_subdirs_list()])
-
-            while True:
-                try:
-                    dir_dent = del_dirs.pop(0)
-                    deleted_dirs.append(DiffEntry(dir_dent.path, dir_dent.obj_id))
-                except IndexError:
-                    break
-                d = fs_mgr.load_syncwdir(self.repo_id, self.version, dir_dent.obj_id)
-                deleted_files.extend([DiffEntry(make_path(dir_dent.path, dent.name), dent.id, dent.size) for dent in d.get_files_list()])
-
-                del_dirs.extend([DiffEntry(make_path(dir_dent.path, dent.name), dent.id) for dent in d.get_subdirs_list()])
+            changes.extend([(change, entry.path, entry.obj_id, entry.size) for change, entry in \
+                            self._expand_dirs(new_dirs, del_dirs)])
+
+        self.diff_cache.put(key, changes)
+        return changes
+
+class ChainDiffer(object):
+    '''Compute the changes between each pair of adjacent roots of root_ids,
+    e.g. the root ids of consecutive commits, oldest first.
+
+    The steps share the dirs they load: the new dirs of a step are the old
+    dirs of the next one, so they are only loaded once. Up to prefetch steps
+    are computed in the background ahead of the one being consumed.
+
+    The other arguments are passed to the CommitDiffer of each step.
+
+    '''
+    def __init__(self, repo_id, version, root_ids, handle_rename=False, fold_dirs=False,
+                 parallel=False, batch_size=500, paths=None, diff_cache=None, prefetch=1):
+        self.repo_id = repo_id
+        self.version = version
+        self.root_ids = list(root_ids)
+        self.differ_args = dict(handle_rename=handle_rename, fold_dirs=fold_dirs,
+                                parallel=parallel, batch_size=batch_size,
+                                paths=paths, diff_cache=diff_cache)
+        self.prefetch = prefetch
+
+    def diff(self):
+        '''Return the list of the diff() results of each step'''
+        return list(self.iter_diffs())
+
+    def iter_diffs(self):
+        '''Generate the diff() result of each step in order'''
+        dirs = _SharedDirs(self.repo_id, self.version)
+        steps = [_ChainStepDiffer(dirs, i, self.repo_id, self.version,
+                                  self.root_ids[i], self.root_ids[i+1], **self.differ_args)
+                 for i in xrange(len(self.root_ids) - 1)]
+
+        pending = []
+        for i, step in enumerate(steps):
+            while len(pending) <= self.prefetch and i + len(pending) < len(steps):
+                pending.append(chain_diff_pool.apply_async(steps[i+len(pending)].diff))
+            result = pending.pop(0).get()
+            # Only the dirs of this step may be needed by the next one.
+            dirs.expire(i)
+            yield result
+
+class _SharedDirs(object):
+    '''The dirs loaded by the steps of a ChainDiffer. Each dir is tagged with
+    the last step that used it, so that older dirs can be dropped.
+
+    '''
+    def __init__(self, repo_id, version):
+        self.repo_id = repo_id
+        self.version = version
+        self._dirs = {} # dir_id -> [SyncwDir, step]
+        self._lock = threading.Lock()
+
+    def get(self, dir_id, step):
+        with self._lock:
+            item = self._dirs.get(dir_id)
+            if item is not None:
+                item[1] = max(item[1], step)
+                return item[0]
+
+        d = fs_mgr.load_syncwdir(self.repo_id, self.version, dir_id)
+        with self._lock:
+            self._dirs[dir_id] = [d, step]
+        return d
+
+    def get_many(self, dir_ids, step):
+        dirs = {}
+        with self._lock:
+            for dir_id in dir_ids:
+                item = self._dirs.get(dir_id)
+                if item is not None:
+                    item[1] = max(item[1], step)
+                    dirs[dir_id] = item[0]
+
+        to_load = list(set([dir_id for dir_id in dir_ids if dir_id not in dirs]))
+        if to_load:
+            loaded = fs_mgr.load_syncwdirs(self.repo_id, self.version, to_load)
+            with self._lock:
+                for dir_id, d in zip(to_load, loaded):
+                    self._dirs[dir_id] = [d, step]
+                    dirs[dir_id] = d
+
+        return [dirs[dir_id] for dir_id in dir_ids]
 
+    def expire(self, step):
+        '''Drop the dirs not used since before step'''
+        with self._lock:
+            for dir_id, item in self._dirs.items():
+                if item[1] < step:
+                    del self._dirs[dir_id]
+
+class _ChainStepDiffer(CommitDiffer):
+    def __init__(self, dirs, step, *args, **kwargs):
+        CommitDiffer.__init__(self, *args, **kwargs)
+        self.dirs = dirs
+        self.step = step
+
+    def _load_dir(self, dir_id):
+        return self.dirs.get(dir_id, self.step)
+
+    def _load_dir_list(self, dir_ids):
+        return self.dirs.get_many(dir_ids, self.step)
+
+def diff_batch(jobs, processes=None, **kwargs):
+    '''Diff many pairs of roots, possibly of different repos, in a pool of
+    processes. jobs is an iterable of (repo_id, version, root1, root2)
+    tuples, and the other arguments are passed to the CommitDiffer of each
+    job.
+
+    Yield a (job, result, error) tuple for each job as soon as it's done,
+    where result is the CommitDiffer.diff() of the job, or error is the
+    formatted traceback if it failed.
+
+    '''
+    pool = multiprocessing.Pool(processes, initializer=_init_diff_worker)
+    try:
+        for ret in pool.imap_unordered(_diff_job, [(job, kwargs) for job in jobs]):
+            yield ret
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _init_diff_worker():
+    # The backend and database connections inherited from the parent
+    # process can't be shared with it.
+    objstore_factory.reset_clients()
+
+def _diff_job(args):
+    job, kwargs = args
+    repo_id, version, root1, root2 = job
+    try:
+        result = CommitDiffer(repo_id, version, root1, root2, **kwargs).diff()
+    except Exception:
+        logging.exception('Failed to diff %s..%s of repo %s', root1, root2, repo_id)
+        return job, None, traceback.format_exc()
+    return job, result, None
+
+def detect_renames(changes):
+    '''Turn the matching added and deleted entries of a stream of changes
+    into renames (same parent dir) or moves.
+
+    Modified files are passed through right away, the other changes are
+    buffered until the input stream ends.
+
+    '''
+    added_files = []
+    deleted_files = []
+    added_dirs = []
+    deleted_dirs = []
+    buffers = {
+        ADDED_FILE: added_files,
+        DELETED_FILE: deleted_files,
+        ADDED_DIR: added_dirs,
+        DELETED_DIR: deleted_dirs,
+    }
+    for change, entry in changes:
+        if change in buffers:
+            buffers[change].append(entry)
         else:
-            deleted_dirs = del_dirs
-            added_dirs = new_dirs
+            yield change, entry
 
-        if self.handle_rename:
-            ret_added_files = []
-            ret_added_dirs = []
-
-            # If an empty file or dir is generated from renaming or moving, just add it into both added_files
-            # and deleted_files, because we can't know where it actually come from.
-            del_file_dict = {}
-            for de in deleted_files:
-                if de.obj_id != ZERO_OBJ_ID:
-                    del_file_dict[de.obj_id] = de
-
-            for de in added_files:
-                if de.obj_id in del_file_dict:
-                    del_de = del_file_dict[de.obj_id]
-                    if os.path.dirname(de.path) == os.path.dirname(del_de.path):
-                        # it's a rename operation if add and del are in the same dir
-                        renamed_files.append(DiffEntry(del_de.path, de.obj_id, de.size, de.path))
-                    else:
-                        moved_files.append(DiffEntry(del_de.path, de.obj_id, de.size, de.path))
-                    del del_file_dict[de.obj_id]
-                else:
-                    ret_added_files.append(de)
-
-            del_dir_dict = {}
-            for de in deleted_dirs:
-                if de.obj_id != ZERO_OBJ_ID:
-                    del_dir_dict[de.obj_id] = de
-
-            for de in added_dirs:
-                if de.obj_id in del_dir_dict:
-                    del_de = del_dir_dict[de.obj_id]
-                    if os.path.dirname(de.path) == os.path.dirname(del_de.path):
-                        renamed_dirs.append(DiffEntry(del_de.path, de.obj_id, -1, de.path))
-                    else:
-                        moved_dirs.append(DiffEntry(del_de.path, de.obj_id, -1, de.path))
-                    del del_dir_dict[de.obj_id]
+    for added, deleted, renamed_change, moved_change, added_change, deleted_change in \
+            ((added_files, deleted_files, RENAMED_FILE, MOVED_FILE, ADDED_FILE, DELETED_FILE),
+             (added_dirs, deleted_dirs, RENAMED_DIR, MOVED_DIR, ADDED_DIR, DELETED_DIR)):
+        # If an empty file or dir is generated from renaming or moving, just add it into both added
+        # and deleted, because we can't know where it actually come from.
+        del_dict = {}
+        for de in deleted:
+            if de.obj_id != ZERO_OBJ_ID:
+                del_dict[de.obj_id] = de
+
+        for de in added:
+            if de.obj_id in del_dict:
+                del_de = del_dict.pop(de.obj_id)
+                if os.path.dirname(de.path) == os.path.dirname(del_de.path):
+                    # it's a rename operation if add and del are in the same dir
+                    change = renamed_change
                 else:
-                    ret_added_dirs.append(de)
-
-            ret_deleted_files = del_file_dict.values()
-            ret_deleted_dirs = del_dir_dict.values()
-            for de in deleted_files:
-                if de.obj_id == ZERO_OBJ_ID:
-                    ret_deleted_files.append(de)
-            for de in deleted_dirs:
-                if de.obj_id == ZERO_OBJ_ID:
-                    ret_deleted_dirs.append(de)
-        else:
-            ret_added_files = added_files
-            ret_deleted_files = deleted_files
-            ret_added_dirs = added_dirs
-            ret_deleted_dirs = deleted_dirs
+                    change = moved_change
+                yield change, DiffEntry(del_de.path, de.obj_id, de.size, de.path)
+            else:
+                yield added_change, de
 
-        return (ret_added_files, ret_deleted_files, ret_added_dirs, ret_deleted_dirs,
-                modified_files, renamed_files, moved_files,
-                renamed_dirs, moved_dirs)
+        for de in del_dict.values():
+            yield deleted_change, de
+        for de in deleted:
+            if de.obj_id == ZERO_OBJ_ID:
+                yield deleted_change, de
+
+def normalize_paths(paths):
+    '''Return the absolute form of paths, without the paths that are under
+    another one of them, or None if the whole tree is included.
+
+    '''
+    if not paths:
+        return None
+    if isinstance(paths, basestring):
+        paths = [paths]
+
+    # Sorting by components puts the paths under a dir right after it,
+    # before siblings such as '/docs-old' for '/docs'.
+    ret = []
+    for path in sorted(set(['/' + to_utf8(path).strip('/') for path in paths]),
+                       key=lambda path: path.split('/')):
+        if path == '/':
+            return None
+        if ret and path.startswith(ret[-1] + '/'):
+            continue
+        ret.append(path)
+    return ret
+
+def join_path(dirname, sub_path):
+    '''Return the path of sub_path, an absolute path relative to dirname'''
+    if dirname == '/':
+        return sub_path
+    else:
+        return dirname + sub_path
 
 def make_path(dirname, filename):
     if dirname == '/':
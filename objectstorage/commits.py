@@ -1,27 +1,126 @@
 from .objstore_factory import objstore_factory
 from .objstore_factory import get_repo_storage_id
 from objectstorage.utils import to_utf8
-
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from objectstorage.utils import json_decoders
+from objectstorage.utils.lazy import LazyObject
 
 class SyncwCommit(object):
-    def __init__(self, _dict):
-        self._dict = _dict
+    '''A commit object. The usual fields of commits are stored in slots,
+    any other key of the commit is kept in an overflow dict. Fields missing
+    from the commit raise AttributeError, like unknown attributes. Other
+    attributes can be set too, they are kept in the overflow dict.
+
+    '''
+    FIELDS = ('commit_id', 'repo_id', 'root_id', 'parent_id', 'second_parent_id',
+              'creator', 'creator_name', 'description', 'ctime', 'version',
+              'encrypted', 'enc_version', 'magic', 'random_key', 'salt', 'key',
+              'repo_name', 'repo_desc', 'repo_category', 'device_name',
+              'client_version', 'no_local_history', 'conflict', 'new_merge',
+              'repaired')
+
+    __slots__ = FIELDS + ('_extra', )
+
+    def __init__(self, _dict=None):
+        object.__setattr__(self, '_extra', None)
+        if _dict:
+            self._set_fields(_dict, False)
+
+    def _set_fields(self, commit_dict, utf8_keys):
+        '''Fill the commit from the decoded json object, in one pass'''
+        # Setting the slots directly skips __setattr__
+        setters = _FIELD_SETTERS
+        extra = None
+        for k, v in commit_dict.iteritems():
+            if k in setters:
+                setters[k](self, v)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[to_utf8(k) if utf8_keys else k] = v
+        object.__setattr__(self, '_extra', extra)
+
+    def __setattr__(self, key, value):
+        if key in _COMMIT_FIELDS or hasattr(type(self), key):
+            object.__setattr__(self, key, value)
+            return
+        extra = self._extra
+        if extra is None:
+            extra = {}
+            object.__setattr__(self, '_extra', extra)
+        extra[key] = value
+
+    def __delattr__(self, key):
+        if key in _COMMIT_FIELDS or hasattr(type(self), key):
+            object.__delattr__(self, key)
+            return
+        extra = self._extra
+        if extra is None or key not in extra:
+            raise AttributeError(key)
+        del extra[key]
 
     def __getattr__(self, key):
-        if key in self._dict:
-            return self._dict[key]
-        return object.__getattribute__(self, key)
-        
+        # Only called when key is neither a set slot nor a method
+        if key == '_extra':
+            raise AttributeError(key)
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        raise AttributeError(key)
+
+    @property
+    def _dict(self):
+        '''All the keys of the commit, as a read-only dict. It's a copy: set
+        or delete the attributes of the commit to change it, or assign a
+        whole new dict to _dict.
+
+        '''
+        return _ReadOnlyDict(self._get_fields())
+
+    @_dict.setter
+    def _dict(self, commit_dict):
+        for k in self.FIELDS:
+            if hasattr(self, k):
+                object.__delattr__(self, k)
+        self._set_fields(commit_dict, False)
+
+    def _get_fields(self):
+        d = dict(self._extra) if self._extra else {}
+        for k in self.FIELDS:
+            try:
+                d[k] = object.__getattribute__(self, k)
+            except AttributeError:
+                pass
+        return d
+
+    def __getstate__(self):
+        return self._get_fields()
+
+    def __setstate__(self, state):
+        self._set_fields(state, False)
+
     def get_version(self):
-        return self._dict.get('version', 0)
+        return getattr(self, 'version', 0)
+
+_COMMIT_FIELDS = frozenset(SyncwCommit.FIELDS)
+_FIELD_SETTERS = dict([(k, SyncwCommit.__dict__[k].__set__) for k in SyncwCommit.FIELDS])
+
+class _ReadOnlyDict(dict):
+    '''A dict that can't be changed, so that the changes to a copy of the
+    fields of a commit don't get silently lost.
+
+    '''
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('SyncwCommit._dict is read-only, set the attributes of the commit instead')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return dict, (dict(self), )
 
 class SyncwCommitManager(object):
     def __init__(self):
-        if objstore_factory.enable_storage_classes:
+        self._storage_classes = objstore_factory.enable_storage_classes
+        if self._storage_classes:
             self.obj_stores = objstore_factory.get_obj_stores('commits')
         else:
             self.obj_store = objstore_factory.get_obj_store('commits')
@@ -30,28 +129,37 @@ class SyncwCommitManager(object):
     def read_count(self):
         return self._counter
 
+    def _get_obj_store(self, repo_id):
+        if not self._storage_classes:
+            return self.obj_store
+
+        storage_id = get_repo_storage_id(repo_id)
+        if storage_id:
+            return self.obj_stores[storage_id]
+        else:
+            return self.obj_stores['__default__']
+
     def load_commit(self, repo_id, version, obj_id, ret_unicode=False):
         self._counter += 1
-        if not objstore_factory.enable_storage_classes:
-            data = self.obj_store.read_obj(repo_id, version, obj_id)
-        else:
-            storage_id = get_repo_storage_id(repo_id)
-            if storage_id:
-                data = self.obj_stores[storage_id].read_obj(repo_id, version, obj_id)
-            else:
-                data = self.obj_stores['__default__'].read_obj(repo_id, version, obj_id)
+        data = self._get_obj_store(repo_id).read_obj(repo_id, version, obj_id)
 
         return self.parse_commit(data, ret_unicode)
 
-    def parse_commit(self, data, ret_unicode=False):
-        commit_dict = json.loads(data)
-        if ret_unicode:
-            return SyncwCommit(commit_dict)
+    def load_commits(self, repo_id, version, obj_ids, ret_unicode=False):
+        '''Load many commits at once, reading them concurrently. Return the
+        commits in the order of obj_ids.
 
-        d = {}
-        for k, v in commit_dict.iteritems():
-            d[to_utf8(k)] = v
-        return SyncwCommit(d)
+        '''
+        self._counter += len(obj_ids)
+        obj_store = self._get_obj_store(repo_id)
+
+        return [self.parse_commit(data, ret_unicode) for _, data in \
+                obj_store.read_objs(repo_id, version, obj_ids)]
+
+    def parse_commit(self, data, ret_unicode=False):
+        commit = SyncwCommit()
+        commit._set_fields(json_decoders.loads(data), not ret_unicode)
+        return commit
 
     def is_commit_encrypted(self, repo_id, version, commit_id):
         commit = self.load_commit(repo_id, version, commit_id)
@@ -68,4 +176,4 @@ class SyncwCommitManager(object):
             return self.obj_store.get_name()
 
 
-commit_mgr = SyncwCommitManager()
+commit_mgr = LazyObject(SyncwCommitManager)
@@ -86,8 +86,11 @@ def init_db_session_class(config):
     except ConfigParser.NoOptionError, ConfigParser.NoSectionError:
         raise RuntimeError("invalid syncwerk config.")
 
-    # reflect the tables
-    Base.prepare(engine, reflect=True)
+    # Only the RepoStorageId table is used, reflecting the whole schema
+    # would make startup slow.
+    if 'RepoStorageId' not in Base.metadata.tables:
+        Base.metadata.reflect(engine, only=['RepoStorageId'])
+        Base.prepare()
 
     Session = sessionmaker(bind=engine)
     return Session
@@ -1,15 +1,23 @@
+import os
 import logging
+import bisect
+import collections
 import struct
 import stat
-import json
 import binascii
+import zlib
+import multiprocessing
 
-from objectstorage.exceptions import ObjectFormatError
+from objectstorage.exceptions import ObjectFormatError, SyncwObjException
 from objectstorage.utils import to_utf8
+from objectstorage.utils import json_decoders
 
 from .objstore_factory import objstore_factory
 from .objstore_factory import get_repo_storage_id
 from .blocks import block_mgr
+from objectstorage.utils.cache import LRUCache
+from objectstorage.utils.threads import SharedThreadPool, SharedProcessPool
+from objectstorage.utils.lazy import LazyObject
 
 ZERO_OBJ_ID = '0000000000000000000000000000000000000000'
 
@@ -17,19 +25,67 @@ SYNCW_METADATA_TYPE_FILE = 1
 SYNCW_METADATA_TYPE_LINK = 2
 SYNCW_METADATA_TYPE_DIR = 3
 
+# Rough per-object memory overhead used to estimate the size of cached
+# fs objects. They don't need to be exact, only proportional.
+DIRENT_OVERHEAD = 250
+JSON_DIRENT_OVERHEAD = 600
+FS_OBJ_OVERHEAD = 500
+
+# Limits for SyncwerkStream read-ahead. The thread pool is shared by all
+# streams of the process.
+READAHEAD_THREADS = 8
+READAHEAD_MAX_BYTES = 64 * 1024 * 1024
+
+readahead_pool = SharedThreadPool(READAHEAD_THREADS)
+
+# Block offset indexes of files, used by SyncwerkStream.seek(), keyed by
+# (store_id, version, file_id).
+BLOCK_OFFSETS_CACHE_SIZE = 16 * 1024 * 1024
+
+block_offsets_cache = LRUCache(BLOCK_OFFSETS_CACHE_SIZE,
+                               sizeof=lambda offsets: FS_OBJ_OVERHEAD + 8 * len(offsets))
+
+# Precompiled formats of the v0 (binary) fs objects
+V0_DIR_HEADER = struct.Struct('!i')
+V0_DIRENT_HEADER = struct.Struct('!i40si')
+V0_FILE_HEADER = struct.Struct('!iq')
+S_IFMT = 0170000
+
+# Number of objects sent at once to a cpu worker process
+CPU_TASK_CHUNKSIZE = 4
+
 logger = logging.getLogger('objectstorage.fs')
 
 class SyncwDirent(object):
-    '''An entry in a SyncwDir'''
+    '''An entry in a SyncwDir
+
+    Large dirs have many entries, so the object id is kept as 20 raw bytes
+    in raw_id, and converted to hex by the id property.
+
+    '''
+    __slots__ = ('name', 'type', 'raw_id', 'mtime', 'size')
+
     DIR = 0
     FILE = 1
     def __init__(self, name, type, id, mtime, size):
         self.name = name
         self.type = type
-        self.id = id
+        self.raw_id = binascii.a2b_hex(id)
         self.mtime = mtime
         self.size = size
 
+    @property
+    def id(self):
+        hex_id = binascii.b2a_hex(self.raw_id)
+        # Entries parsed with ret_unicode have unicode names and ids.
+        if isinstance(self.name, unicode):
+            return hex_id.decode('ascii')
+        return hex_id
+
+    @id.setter
+    def id(self, id):
+        self.raw_id = binascii.a2b_hex(id)
+
     def is_file(self):
         return self.type == SyncwDirent.FILE
 
@@ -48,49 +104,246 @@ class SyncwDirent(object):
     def fromV1(name, type, id, mtime, size):
         return SyncwDirent(name, type, id, mtime, size)
 
+    @staticmethod
+    def from_raw_id(name, type, raw_id, mtime, size):
+        dent = SyncwDirent.__new__(SyncwDirent)
+        dent.name = name
+        dent.type = type
+        dent.raw_id = raw_id
+        dent.mtime = mtime
+        dent.size = size
+        return dent
+
 
 class SyncwDir(object):
+    '''A dir object. It's either created with its dirents, or lazily from
+    the decoded json entries of a v1 dir (see SyncwDir.from_json_entries).
+    A lazy dir only builds the dirents that are asked for, until all of
+    them are needed.
+
+    Dirs are shared by threads through the fs cache. When the dirents are
+    built, _dirents is set before _entries is cleared, so a reader that
+    finds both of them None knows it can read _dirents again (see
+    _get_state()).
+
+    The dirs returned by the fs cache are shared, and read-only: modify a
+    copy() of them instead.
+
+    '''
     def __init__(self, store_id, version, obj_id, dirents):
         self.version = version
         self.store_id = store_id
         self.obj_id = obj_id
 
-        self.dirents = dirents
+        self._dirents = dirents
+        self._entries = None
+        self._entries_index = None
+        self._ret_unicode = False
+        self._shared = False
+
+        self._cached_files_list = None
+        self._cached_dirs_list = None
+        self._cached_sorted_list = None
+
+    @staticmethod
+    def from_json_entries(store_id, version, obj_id, entries, ret_unicode=False):
+        d = SyncwDir(store_id, version, obj_id, None)
+        d._entries = entries
+        d._ret_unicode = ret_unicode
+        return d
+
+    def _get_state(self):
+        '''Return (dirents, entries), only one of which isn't None'''
+        dirents = self._dirents
+        if dirents is not None:
+            return dirents, None
+        entries = self._entries
+        if entries is None:
+            # The dirents were built by another thread meanwhile.
+            return self._dirents, None
+        return None, entries
+
+    @property
+    def dirents(self):
+        dirents, entries = self._get_state()
+        if dirents is None:
+            # Another thread may build them too, either result is fine.
+            dirents = dirents_from_json(entries, self.obj_id, self._ret_unicode)
+            self._dirents = dirents
+            self._entries = None
+            self._entries_index = None
+        return dirents
+
+    @dirents.setter
+    def dirents(self, dirents):
+        self._check_writable()
+        self._dirents = dirents
+        self._entries = None
+        self._entries_index = None
+        self._clear_cached_lists()
+
+    def _check_writable(self):
+        if self._shared:
+            raise RuntimeError('dir %s is shared through the fs cache, modify a copy of it'
+                               % self.obj_id)
 
+    def _clear_cached_lists(self):
         self._cached_files_list = None
         self._cached_dirs_list = None
+        self._cached_sorted_list = None
+
+    def copy(self):
+        '''Return a private copy of this dir, which can be modified'''
+        d = SyncwDir(self.store_id, self.version, self.obj_id, dict(self.dirents))
+        d._ret_unicode = self._ret_unicode
+        return d
+
+    def is_lazy(self):
+        '''Return True if the dirents haven't all been built yet'''
+        return self._dirents is None
+
+    def _filter_dirents(self, type):
+        dirents, entries = self._get_state()
+        if dirents is not None:
+            return [ dent for dent in dirents.itervalues() if dent.type == type ]
+
+        dents = {}
+        for entry in entries:
+            if dirent_type_from_mode(entry['mode']) == type:
+                dent = dirent_from_json(entry, self.obj_id, self._ret_unicode)
+                dents[dent.name] = dent
+        return dents.values()
 
     def get_files_list(self):
         if self._cached_files_list is None:
-            self._cached_files_list = [ dent for dent in self.dirents.itervalues() \
-                                        if dent.type == SyncwDirent.FILE ]
+            self._cached_files_list = self._filter_dirents(SyncwDirent.FILE)
 
         return self._cached_files_list
 
     def get_subdirs_list(self):
         if self._cached_dirs_list is None:
-            self._cached_dirs_list = [ dent for dent in self.dirents.itervalues() \
-                                        if dent.type == SyncwDirent.DIR ]
+            self._cached_dirs_list = self._filter_dirents(SyncwDirent.DIR)
 
         return self._cached_dirs_list
 
+    def get_sorted_dirents(self):
+        '''Return all the dirents, sorted by name'''
+        if self._cached_sorted_list is None:
+            self._cached_sorted_list = sorted(self.dirents.itervalues(),
+                                              key=lambda dent: dent.name)
+
+        return self._cached_sorted_list
+
     def lookup_dent(self, name):
-        return self.dirents.get(name, None)
+        dirents, entries = self._get_state()
+        if dirents is not None:
+            return dirents.get(name, None)
+
+        # Index the json entries by name, which is much cheaper than
+        # building all the dirents.
+        index = self._entries_index
+        if index is None:
+            index = {entry['name']: entry for entry in entries}
+            self._entries_index = index
+
+        if isinstance(name, str):
+            try:
+                name = name.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+        entry = index.get(name)
+        if entry is None or dirent_type_from_mode(entry['mode']) is None:
+            return None
+        return dirent_from_json(entry, self.obj_id, self._ret_unicode)
 
     def lookup(self, name):
         name = to_utf8(name)
-        if name not in self.dirents:
+        dent = self.lookup_dent(name)
+        if dent is None:
             return None
 
-        dent = self.dirents[name]
         if dent.is_dir():
             return fs_mgr.load_syncwdir(self.store_id, self.version, dent.id)
         else:
             return fs_mgr.load_syncwerk(self.store_id, self.version, dent.id)
 
     def remove_entry(self, name):
-        if name in self.dirents:
-            del self.dirents[name]
+        self._check_writable()
+        dirents = self.dirents
+        if name in dirents:
+            del dirents[name]
+            self._clear_cached_lists()
+
+class BlockList(object):
+    '''The block ids of a file, packed in a single string of raw 20 bytes
+    ids. Supports the read-only list operations (len, indexing, slicing,
+    iteration), which return the ids in hex.
+
+    '''
+    __slots__ = ('raw',)
+
+    ID_SIZE = 20
+
+    def __init__(self, raw=''):
+        if len(raw) % self.ID_SIZE != 0:
+            raise ValueError('invalid packed block ids length %d' % len(raw))
+        self.raw = raw
+
+    @staticmethod
+    def from_hex(block_ids):
+        return BlockList(binascii.a2b_hex(''.join(block_ids)))
+
+    def __len__(self):
+        return len(self.raw) // self.ID_SIZE
+
+    def __getitem__(self, idx):
+        n = len(self)
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(n)
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            stop = max(start, stop)
+            return BlockList(self.raw[start*self.ID_SIZE:stop*self.ID_SIZE])
+
+        if idx < 0:
+            idx += n
+        if idx < 0 or idx >= n:
+            raise IndexError('block index out of range')
+        off = idx * self.ID_SIZE
+        return binascii.b2a_hex(self.raw[off:off+self.ID_SIZE])
+
+    def __iter__(self):
+        hex_ids = binascii.b2a_hex(self.raw)
+        step = 2 * self.ID_SIZE
+        for off in xrange(0, len(hex_ids), step):
+            yield hex_ids[off:off+step]
+
+    def __contains__(self, block_id):
+        try:
+            raw_id = binascii.a2b_hex(to_utf8(block_id))
+        except TypeError:
+            return False
+        if len(raw_id) != self.ID_SIZE:
+            return False
+        off = self.raw.find(raw_id)
+        while off >= 0:
+            if off % self.ID_SIZE == 0:
+                return True
+            off = self.raw.find(raw_id, off + 1)
+        return False
+
+    def __eq__(self, other):
+        if isinstance(other, BlockList):
+            return self.raw == other.raw
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BlockList(%r)' % list(self)
 
 class SyncwFile(object):
     def __init__(self, store_id, version, obj_id, blocks, size):
@@ -101,66 +354,254 @@ class SyncwFile(object):
         self.blocks = blocks
         self.size = size
 
-        self._content = None
-
-    def get_stream(self):
-        return SyncwerkStream(self)
+    def get_stream(self, readahead=0):
+        return SyncwerkStream(self, readahead)
+
+    def read_range(self, offset, length):
+        '''Read up to length bytes of the file starting at offset, fetching
+        only the parts of the blocks that overlap the range.
+
+        '''
+        length = min(length, self.size - offset)
+        if offset < 0 or length <= 0:
+            return ''
+
+        offsets = self.get_block_offsets()
+        idx = bisect.bisect_right(offsets, offset) - 1
+        parts = []
+        while length > 0 and idx < len(self.blocks):
+            block_offset = offset - offsets[idx]
+            if idx + 1 < len(offsets):
+                n = min(length, offsets[idx + 1] - offset)
+            else:
+                n = length
+            parts.append(block_mgr.load_block_range(self.store_id, self.version,
+                                                    self.blocks[idx], block_offset, n))
+            offset += n
+            length -= n
+            idx += 1
+
+        return ''.join(parts)
+
+    def get_block_offsets(self):
+        '''Return the offset in the file of the start of each block. Block
+        sizes are looked up in the backend on first use, then remembered.
+
+        '''
+        key = (self.store_id, self.version, self.obj_id)
+        offsets = block_offsets_cache.get(key)
+        if offsets is not None:
+            return offsets
+
+        # The size of the last block follows from the file size.
+        def stat(block_id):
+            return block_mgr.stat_block(self.store_id, self.version, block_id)
+        sizes = readahead_pool.get().map(stat, self.blocks[:-1])
+
+        offsets = []
+        off = 0
+        for size in sizes:
+            offsets.append(off)
+            off += size
+        if self.blocks:
+            offsets.append(off)
+
+        block_offsets_cache.put(key, offsets)
+        return offsets
 
     def get_content(self, limit=-1):
-        if limit <= 0:
+        # The content is not kept on the object: SyncwFile objects may be
+        # long lived in the fs object cache, and repeated reads of popular
+        # blocks are served by the block cache instead.
+        if limit <= 0 or limit > self.size:
             limit = self.size
-        if limit >= self.size:
-            if self._content is None:
-                stream = self.get_stream()
-                self._content = stream.read(limit)
-            return self._content
-        else:
-            stream = self.get_stream()
-            return stream.read(limit)
+        stream = self.get_stream()
+        return stream.read(limit)
 
 class SyncwerkStream(object):
-    '''Implements basic file-like interface'''
-    def __init__(self, file_obj):
+    '''Implements basic file-like interface
+
+    If readahead is positive, up to that many of the following blocks are
+    loaded in the background while the current one is consumed. The depth
+    starts at one block and doubles with each block read, and the blocks
+    buffered ahead are kept under max_readahead_bytes.
+
+    '''
+    def __init__(self, file_obj, readahead=0, max_readahead_bytes=READAHEAD_MAX_BYTES):
         self.file_obj = file_obj
         self.block = None
         self.block_idx = 0
         self.block_offset = 0
+        self.pos = 0
+        self._seek_offset = 0
+
+        self.readahead = readahead
+        self.max_readahead_bytes = max_readahead_bytes
+        self._prefetched = collections.deque()
+        self._prefetch_depth = 1
+        self._max_block_size = 0
+
+    def _load_next_block(self):
+        blocks = self.file_obj.blocks
+        if self.readahead <= 0:
+            block = block_mgr.load_block(self.file_obj.store_id,
+                                         self.file_obj.version,
+                                         blocks[self.block_idx])
+        else:
+            if not self._prefetched:
+                self._prefetch()
+            block = self._prefetched.popleft().get()
+            self._max_block_size = max(self._max_block_size, len(block))
+            self._prefetch_depth = min(self._prefetch_depth * 2, self.readahead)
+
+        self.block = block
+        self.block_idx += 1
+        self.block_offset = self._seek_offset
+        self._seek_offset = 0
+
+        if self.readahead > 0:
+            self._prefetch()
+
+    def _prefetch(self):
+        '''Schedule loading of the blocks following the current one'''
+        blocks = self.file_obj.blocks
+        # Always allow one block to be in flight, or we could never make
+        # progress when a single block is larger than the limit.
+        while len(self._prefetched) < self._prefetch_depth:
+            idx = self.block_idx + len(self._prefetched)
+            if idx >= len(blocks):
+                break
+            if self._prefetched and \
+               (len(self._prefetched) + 1) * self._max_block_size > self.max_readahead_bytes:
+                break
+            self._prefetched.append(readahead_pool.apply_async(block_mgr.load_block,
+                                                               (self.file_obj.store_id,
+                                                                self.file_obj.version,
+                                                                blocks[idx])))
 
     def read(self, size):
         remain = size
         blocks = self.file_obj.blocks
-        ret = ''
+        parts = []
 
         while True:
             if not self.block or self.block_offset == len(self.block):
                 if self.block_idx == len(blocks):
                     break
-                self.block = block_mgr.load_block(self.file_obj.store_id,
-                                                  self.file_obj.version,
-                                                  blocks[self.block_idx])
-                self.block_idx += 1
-                self.block_offset = 0
+                self._load_next_block()
 
             if self.block_offset + remain >= len(self.block):
-                ret += self.block[self.block_offset:]
+                if self.block_offset == 0:
+                    parts.append(self.block)
+                else:
+                    parts.append(self.block[self.block_offset:])
                 remain -= (len(self.block) - self.block_offset)
                 self.block_offset = len(self.block)
             else:
-                ret += self.block[self.block_offset:self.block_offset+remain]
+                parts.append(self.block[self.block_offset:self.block_offset+remain])
                 self.block_offset += remain
                 remain = 0
 
             if remain == 0:
                 break
 
-        return ret
+        self.pos += size - remain
+
+        if len(parts) == 1:
+            return parts[0]
+        return ''.join(parts)
+
+    def readinto(self, buf):
+        '''Read up to len(buf) bytes into the writable buffer buf. Return
+        the number of bytes read, 0 at end of file.
+
+        '''
+        out = memoryview(buf)
+        blocks = self.file_obj.blocks
+        pos = 0
+
+        while pos < len(out):
+            if not self.block or self.block_offset == len(self.block):
+                if self.block_idx == len(blocks):
+                    break
+                self._load_next_block()
+
+            n = min(len(out) - pos, len(self.block) - self.block_offset)
+            out[pos:pos+n] = memoryview(self.block)[self.block_offset:self.block_offset+n]
+            pos += n
+            self.block_offset += n
+
+        self.pos += pos
+        return pos
+
+    def iter_chunks(self):
+        '''Yield the rest of the file as one memoryview per block, without
+        copying or joining the block contents.
+
+        '''
+        blocks = self.file_obj.blocks
+        while True:
+            if not self.block or self.block_offset == len(self.block):
+                if self.block_idx == len(blocks):
+                    break
+                self._load_next_block()
+
+            chunk = memoryview(self.block)[self.block_offset:]
+            self.block_offset = len(self.block)
+            self.pos += len(chunk)
+            yield chunk
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.file_obj.size + offset
+        else:
+            raise ValueError('invalid whence %s' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %d' % pos)
+        pos = min(pos, self.file_obj.size)
+
+        if pos == self.pos:
+            return
+
+        # Seeking inside the current block doesn't need the offset index.
+        if self.block:
+            block_start = self.pos - self.block_offset
+            if block_start <= pos < block_start + len(self.block):
+                self.block_offset = pos - block_start
+                self.pos = pos
+                return
+
+        offsets = self.file_obj.get_block_offsets()
+        idx = bisect.bisect_right(offsets, pos) - 1
+        if pos == self.file_obj.size:
+            idx = len(offsets)
+
+        if idx != self.block_idx:
+            # Not a sequential access, blocks loaded ahead are useless.
+            self._prefetched.clear()
+            self._prefetch_depth = 1
+
+        self.block = None
+        self.block_idx = idx
+        self.block_offset = 0
+        self._seek_offset = pos - offsets[idx] if idx < len(offsets) else 0
+        self.pos = pos
 
     def close(self):
-        pass
+        # Blocks still loading in the background are just dropped.
+        self._prefetched.clear()
 
 class SyncwFSManager(object):
     def __init__(self):
-        if objstore_factory.enable_storage_classes:
+        self._storage_classes = objstore_factory.enable_storage_classes
+        if self._storage_classes:
             self.obj_stores = objstore_factory.get_obj_stores('fs')
         else:
             self.obj_store = objstore_factory.get_obj_store('fs')
@@ -168,146 +609,270 @@ class SyncwFSManager(object):
         self._dir_counter = 0
         self._file_counter = 0
 
+        # Fs objects are content addressed and never change, so parsed
+        # SyncwDir/SyncwFile objects can be cached without invalidation.
+        cache_size = objstore_factory.get_cache_size('fs')
+        if cache_size > 0:
+            self._cache = LRUCache(cache_size, sizeof=estimate_fs_obj_size)
+        else:
+            self._cache = None
+
+        # Batch loads of at least cpu_batch_size objects decrypt, decompress
+        # and parse them in worker processes, to not be limited to one cpu
+        # by the GIL.
+        cpu_workers = objstore_factory.get_cpu_workers('fs')
+        if cpu_workers > 0:
+            self._cpu_batch_size = objstore_factory.get_cpu_batch_size('fs')
+            # SyncwCrypto can't be pickled, the workers get the key material.
+            crypto = objstore_factory.syncwerk_cfg.get_syncw_crypto()
+            if crypto:
+                initargs = (crypto.key, crypto.iv)
+            else:
+                initargs = (None, None)
+            self._cpu_pool = SharedProcessPool(cpu_workers, _init_cpu_worker, initargs)
+        else:
+            self._cpu_pool = None
+
+    def _get_obj_store(self, store_id):
+        if not self._storage_classes:
+            return self.obj_store
+
+        storage_id = get_repo_storage_id(store_id)
+        if storage_id:
+            return self.obj_stores[storage_id]
+        else:
+            return self.obj_stores['__default__']
+
     def load_syncwerk(self, store_id, version, file_id):
         self._file_counter += 1
 
-        blocks = []
-        size = 0
         if file_id == ZERO_OBJ_ID:
-            pass
-        else:
-            if not objstore_factory.enable_storage_classes:
-                data = self.obj_store.read_obj(store_id, version, file_id)
-            else:
-                storage_id = get_repo_storage_id(store_id)
-                if storage_id:
-                    data = self.obj_stores[storage_id].read_obj(store_id, version, file_id)
-                else:
-                    data = self.obj_stores['__default__'].read_obj(store_id, version, file_id)
+            return SyncwFile(store_id, version, file_id, BlockList(), 0)
 
-            if version == 0:
-                blocks, size = self.parse_blocks_v0(data, file_id)
-            elif version == 1:
-                blocks, size = self.parse_blocks_v1(data, file_id)
-            else:
-                raise RuntimeError('invalid fs version ' + str(version))
+        key = ('f', store_id, version, file_id)
+        if self._cache is not None:
+            syncwerk = self._cache.get(key)
+            if syncwerk is not None:
+                return syncwerk
 
-        return SyncwFile(store_id, version, file_id, blocks, size)
+        data = self._get_obj_store(store_id).read_obj(store_id, version, file_id)
+        syncwerk = self._parse_syncwerk(store_id, version, file_id, data)
+        if self._cache is not None:
+            self._cache_put(key, syncwerk)
+
+        return syncwerk
 
     def load_syncwdir(self, store_id, version, dir_id, ret_unicode=False):
         self._dir_counter += 1
 
-        dirents = {}
         if dir_id == ZERO_OBJ_ID:
-            pass
-        else:
-            if not objstore_factory.enable_storage_classes:
-                data = self.obj_store.read_obj(store_id, version, dir_id)
+            return SyncwDir(store_id, version, dir_id, {})
+
+        key = ('d', store_id, version, dir_id, ret_unicode)
+        if self._cache is not None:
+            syncwdir = self._cache.get(key)
+            if syncwdir is not None:
+                return syncwdir
+
+        data = self._get_obj_store(store_id).read_obj(store_id, version, dir_id)
+        syncwdir = self._parse_syncwdir(store_id, version, dir_id, data, ret_unicode)
+        if self._cache is not None:
+            self._cache_put(key, syncwdir)
+
+        return syncwdir
+
+    def load_syncwerks(self, store_id, version, file_ids):
+        '''Load many files at once, reading the objects concurrently. Return
+        the SyncwFile objects in the order of file_ids.
+
+        '''
+        self._file_counter += len(file_ids)
+
+        def make_key(file_id):
+            return ('f', store_id, version, file_id)
+        def make_empty(file_id):
+            return SyncwFile(store_id, version, file_id, BlockList(), 0)
+        def parse(file_id, data):
+            return self._parse_syncwerk(store_id, version, file_id, data)
+
+        return self._load_objs(store_id, version, file_ids, make_key, make_empty, parse,
+                               'f', False)
+
+    def load_syncwdirs(self, store_id, version, dir_ids, ret_unicode=False):
+        '''Load many dirs at once, reading the objects concurrently. Return
+        the SyncwDir objects in the order of dir_ids.
+
+        '''
+        self._dir_counter += len(dir_ids)
+
+        def make_key(dir_id):
+            return ('d', store_id, version, dir_id, ret_unicode)
+        def make_empty(dir_id):
+            return SyncwDir(store_id, version, dir_id, {})
+        def parse(dir_id, data):
+            return self._parse_syncwdir(store_id, version, dir_id, data, ret_unicode)
+
+        return self._load_objs(store_id, version, dir_ids, make_key, make_empty, parse,
+                               'd', ret_unicode)
+
+    def _load_objs(self, store_id, version, obj_ids, make_key, make_empty, parse,
+                   obj_type, ret_unicode):
+        objs = {}
+        to_read = []
+        for obj_id in obj_ids:
+            if obj_id in objs:
+                continue
+            if obj_id == ZERO_OBJ_ID:
+                objs[obj_id] = make_empty(obj_id)
+                continue
+            if self._cache is not None:
+                obj = self._cache.get(make_key(obj_id))
+                if obj is not None:
+                    objs[obj_id] = obj
+                    continue
+            # Placeholder, so duplicated ids are only read once
+            objs[obj_id] = None
+            to_read.append(obj_id)
+
+        if to_read:
+            obj_store = self._get_obj_store(store_id)
+            if self._use_cpu_pool(len(to_read)):
+                loaded = self._load_objs_in_pool(obj_store, store_id, version, to_read,
+                                                 obj_type, ret_unicode)
             else:
-                storage_id = get_repo_storage_id(store_id)
-                if storage_id:
-                    data = self.obj_stores[storage_id].read_obj(store_id, version, dir_id)
-                else:
-                    data = self.obj_stores['__default__'].read_obj(store_id, version, dir_id)
-
-            if version == 0:
-                dirents = self.parse_dirents_v0(data, dir_id)
-            elif version == 1:
-                dirents = self.parse_dirents_v1(data, dir_id, ret_unicode)
+                loaded = ((obj_id, parse(obj_id, data)) for obj_id, data in
+                          obj_store.read_objs(store_id, version, to_read, ordered=False))
+            for obj_id, obj in loaded:
+                if self._cache is not None:
+                    self._cache_put(make_key(obj_id), obj)
+                objs[obj_id] = obj
+
+        return [objs[obj_id] for obj_id in obj_ids]
+
+    def _cache_put(self, key, obj):
+        if isinstance(obj, SyncwDir):
+            # Every later load of the dir returns this very object.
+            obj._shared = True
+        self._cache.put(key, obj)
+
+    def _use_cpu_pool(self, n_objs):
+        if self._cpu_pool is None or n_objs < self._cpu_batch_size:
+            return False
+        # Daemon processes, such as the workers of a multiprocessing Pool,
+        # can't start processes of their own.
+        return not multiprocessing.current_process().daemon
+
+    def _load_objs_in_pool(self, obj_store, store_id, version, obj_ids, obj_type, ret_unicode):
+        '''Read the raw objects concurrently, and decode and parse them in the
+        cpu worker processes. Generate (obj_id, obj) pairs as they are parsed.
+
+        '''
+        encrypted = obj_store.crypto is not None
+        compressed = obj_store.compressed and version == 1
+        # The pool consumes the tasks from its own thread, so the objects
+        # are still being read while the first ones are parsed.
+        tasks = ((store_id, version, obj_id, data, obj_type, ret_unicode, encrypted, compressed)
+                 for obj_id, data in obj_store.read_objs_raw(store_id, version, obj_ids,
+                                                             ordered=False))
+        pool = self._cpu_pool.get()
+        for obj_id, result, error in pool.imap_unordered(_decode_and_parse, tasks,
+                                                         CPU_TASK_CHUNKSIZE):
+            if error is not None:
+                exc_type, msg = error
+                raise exc_type(msg)
+
+            if obj_type == 'd':
+                dirents = {}
+                for name, type, raw_id, mtime, size in result:
+                    dirents[name] = SyncwDirent.from_raw_id(name, type, raw_id, mtime, size)
+                yield obj_id, SyncwDir(store_id, version, obj_id, dirents)
             else:
-                raise RuntimeError('invalid fs version ' + str(version))
+                raw, size = result
+                yield obj_id, SyncwFile(store_id, version, obj_id, BlockList(raw), size)
+
+    def _parse_syncwerk(self, store_id, version, file_id, data):
+        if version == 0:
+            blocks, size = self.parse_blocks_v0(data, file_id)
+        elif version == 1:
+            blocks, size = self.parse_blocks_v1(data, file_id)
+        else:
+            raise RuntimeError('invalid fs version ' + str(version))
+
+        return SyncwFile(store_id, version, file_id, blocks, size)
+
+    def _parse_syncwdir(self, store_id, version, dir_id, data, ret_unicode):
+        if version == 0:
+            dirents = self.parse_dirents_v0(data, dir_id)
+        elif version == 1:
+            # The dirents are only built when needed.
+            entries = json_decoders.loads(data)['dirents']
+            return SyncwDir.from_json_entries(store_id, version, dir_id, entries, ret_unicode)
+        else:
+            raise RuntimeError('invalid fs version ' + str(version))
 
         return SyncwDir(store_id, version, dir_id, dirents)
 
     def parse_dirents_v0(self, data, dir_id):
         '''binary format'''
-        mode, = struct.unpack_from("!i", data, offset = 0)
+        mode, = V0_DIR_HEADER.unpack_from(data, 0)
         if mode != SYNCW_METADATA_TYPE_DIR:
             raise ObjectFormatError('corrupt dir object ' + dir_id)
 
         dirents = {}
 
-        off = 4
+        unpack_header = V0_DIRENT_HEADER.unpack_from
+        header_size = V0_DIRENT_HEADER.size
+        end = len(data) - 48
+        off = V0_DIR_HEADER.size
         while True:
-            fmt = "!i40si"
-            mode, eid, name_len = struct.unpack_from(fmt, data, offset=off)
-            off += struct.calcsize(fmt)
-
-            fmt = "!%ds" % name_len
-            name, = struct.unpack_from(fmt, data, offset = off)
-            off += struct.calcsize(fmt)
-
-            if stat.S_ISREG(mode):
-                dirents[name] = SyncwDirent.fromV0(name, SyncwDirent.FILE, eid)
-            elif stat.S_ISDIR(mode):
-                dirents[name] = SyncwDirent.fromV0(name, SyncwDirent.DIR, eid)
+            mode, eid, name_len = unpack_header(data, off)
+            off += header_size
+            if name_len < 0 or off + name_len > len(data):
+                raise ObjectFormatError('corrupt dir object ' + dir_id)
+            name = data[off:off + name_len]
+            off += name_len
+
+            fmt = mode & S_IFMT
+            if fmt == stat.S_IFREG:
+                dirents[name] = SyncwDirent(name, SyncwDirent.FILE, eid, -1, -1)
+            elif fmt == stat.S_IFDIR:
+                dirents[name] = SyncwDirent(name, SyncwDirent.DIR, eid, -1, -1)
             else:
                 logger.warning('Error: unknown object mode %s', mode)
-            if off > len(data) - 48:
+            if off > end:
                 break
 
         return dirents
 
     def parse_dirents_v1(self, data, dir_id, ret_unicode=False):
         '''json format'''
-        d = json.loads(data)
-
-        dirents = {}
-
-        for entry in d['dirents']:
-            name = entry['name']
-            id = entry['id']
-            mtime = entry['mtime']
-            mode = entry['mode']
-            if stat.S_ISREG(mode):
-                type = SyncwDirent.FILE
-                size = entry['size']
-            elif stat.S_ISDIR(mode):
-                type = SyncwDirent.DIR
-                size = 0
-            else:
-                continue
+        d = json_decoders.loads(data)
 
-            if not ret_unicode:
-                name = to_utf8(name)
-                id = to_utf8(id)
-
-            dirents[name] = SyncwDirent.fromV1(name, type, id, mtime, size)
-
-        return dirents
+        return dirents_from_json(d['dirents'], dir_id, ret_unicode)
 
     def parse_blocks_v0(self, data, obj_id):
         '''binray format'''
-        blocks = []
-
-        fmt = '!iq'
-        mode, size = struct.unpack_from(fmt, data, offset=0)
+        mode, size = V0_FILE_HEADER.unpack_from(data, 0)
         if mode != SYNCW_METADATA_TYPE_FILE:
             raise ObjectFormatError('corrupt file object ' + obj_id)
 
-        off = struct.calcsize(fmt)
-        while True:
-            fmt = "!20s"
-            bid, = struct.unpack_from(fmt, data, offset = off)
-            hexs = []
-            for d in bid:
-                x = binascii.b2a_hex(d)
-                hexs.append(x)
-
-            blk_id = ''.join(hexs)
-            blocks.append(blk_id)
-
-            off += struct.calcsize(fmt)
-            if off > len(data) - 20:
-                break
+        # The rest of the object is the raw block ids, any trailing partial
+        # id is ignored.
+        off = V0_FILE_HEADER.size
+        n_blocks = (len(data) - off) // BlockList.ID_SIZE
+        blocks = BlockList(data[off:off + n_blocks * BlockList.ID_SIZE])
 
         return blocks, size
 
     def parse_blocks_v1(self, data, obj_id):
         ''''json format'''
-        d = json.loads(data)
+        d = json_decoders.loads(data)
 
-        blocks = [ to_utf8(id) for id in d['block_ids'] ]
+        try:
+            # Block ids are plain hex, a2b_hex can take them as unicode.
+            blocks = BlockList.from_hex(d['block_ids'])
+        except (TypeError, UnicodeError):
+            raise ObjectFormatError('corrupt file object ' + obj_id)
         size = d['size']
 
         return blocks, size
@@ -317,5 +882,96 @@ class SyncwFSManager(object):
     def file_read_count(self):
         return self._file_counter
 
+    def cache_hit_count(self):
+        return self._cache.hit_count() if self._cache is not None else 0
+    def cache_miss_count(self):
+        return self._cache.miss_count() if self._cache is not None else 0
+    def cache_evict_count(self):
+        return self._cache.evict_count() if self._cache is not None else 0
+
+def dirent_type_from_mode(mode):
+    if stat.S_ISREG(mode):
+        return SyncwDirent.FILE
+    elif stat.S_ISDIR(mode):
+        return SyncwDirent.DIR
+    else:
+        return None
+
+def dirent_from_json(entry, dir_id, ret_unicode=False):
+    '''Build a SyncwDirent from a decoded v1 dir entry, or return None if the
+    entry is neither a file nor a dir.
+
+    '''
+    type = dirent_type_from_mode(entry['mode'])
+    if type == SyncwDirent.FILE:
+        size = entry['size']
+    elif type == SyncwDirent.DIR:
+        size = 0
+    else:
+        return None
+
+    name = entry['name']
+    if not ret_unicode:
+        name = to_utf8(name)
+
+    try:
+        return SyncwDirent.fromV1(name, type, entry['id'], entry['mtime'], size)
+    except TypeError:
+        raise ObjectFormatError('corrupt dir object ' + dir_id)
+
+def dirents_from_json(entries, dir_id, ret_unicode=False):
+    dirents = {}
+    for entry in entries:
+        dent = dirent_from_json(entry, dir_id, ret_unicode)
+        if dent is not None:
+            dirents[dent.name] = dent
+
+    return dirents
+
+def estimate_fs_obj_size(obj):
+    '''Estimate the memory used by a parsed SyncwDir or SyncwFile'''
+    if isinstance(obj, SyncwDir):
+        dirents, entries = obj._get_state()
+        if dirents is None:
+            return FS_OBJ_OVERHEAD + sum([JSON_DIRENT_OVERHEAD + 4 * len(entry['name']) \
+                                          for entry in entries])
+        return FS_OBJ_OVERHEAD + sum([DIRENT_OVERHEAD + len(name) for name in dirents])
+    else:
+        return FS_OBJ_OVERHEAD + len(obj.blocks) * BlockList.ID_SIZE
+
+_cpu_worker_crypto = None
+
+def _init_cpu_worker(key, iv):
+    global _cpu_worker_crypto
+    if key is not None:
+        from objectstorage.utils.crypto import SyncwCrypto
+        _cpu_worker_crypto = SyncwCrypto(key, iv)
+
+def _decode_and_parse(task):
+    '''Decrypt, decompress and parse a raw fs object in a cpu worker process.
+    Return (obj_id, result, error). The result is made of plain tuples and
+    strings, which are much cheaper to pickle than the parsed objects.
+
+    '''
+    store_id, version, obj_id, data, obj_type, ret_unicode, encrypted, compressed = task
+    try:
+        if encrypted:
+            data = _cpu_worker_crypto.dec_data(data)
+        if compressed:
+            data = zlib.decompress(data)
+
+        if obj_type == 'd':
+            syncwdir = fs_mgr._parse_syncwdir(store_id, version, obj_id, data, ret_unicode)
+            result = [(dent.name, dent.type, dent.raw_id, dent.mtime, dent.size)
+                      for dent in syncwdir.dirents.itervalues()]
+        else:
+            syncwerk = fs_mgr._parse_syncwerk(store_id, version, obj_id, data)
+            result = (syncwerk.blocks.raw, syncwerk.size)
+    except SyncwObjException as e:
+        # These exceptions can't be unpickled, send their type and message.
+        return obj_id, None, (type(e), e.msg)
+
+    return obj_id, result, None
+
 
-fs_mgr = SyncwFSManager()
+fs_mgr = LazyObject(SyncwFSManager)
@@ -3,10 +3,19 @@ import ConfigParser
 import binascii
 import logging
 import json
+import threading
+import time
 
 from objectstorage.exceptions import InvalidConfigError
+from objectstorage.utils.lazy import LazyObject
 from objectstorage.backends.filesystem import SyncwObjStoreFS
 
+# Default minimum size of the batch loads decoded by the cpu worker processes
+CPU_BATCH_SIZE = 64
+
+# Default time in seconds after which the repo storage ids are refreshed
+REPO_STORAGE_ID_TTL = 60
+
 def get_ceph_conf(cfg, section):
     config_file = cfg.get(section, 'ceph_config')
     pool_name = cfg.get(section, 'pool')
@@ -165,6 +174,8 @@ def get_swift_conf_from_json (cfg):
 class SyncwerkConfig(object):
     def __init__(self):
         self.cfg = None
+        self._crypto = None
+        self._crypto_loaded = False
         self.syncwerk_conf_dir = os.environ['SYNCWERK_CONF_DIR']
         self.central_config_dir = os.environ.get('SYNCWERK_CENTRAL_CONF_DIR',
                                                  None)
@@ -181,9 +192,21 @@ class SyncwerkConfig(object):
         return self.cfg
 
     def get_syncw_crypto(self):
-        if not self.cfg.has_option('store_crypt', 'key_path'):
+        '''Return the SyncwCrypto of the key file, or None if the store isn't
+        encrypted. The key file is only read once, the SyncwCrypto is shared
+        by all the object stores.
+
+        '''
+        if not self._crypto_loaded:
+            self._crypto = self._load_syncw_crypto()
+            self._crypto_loaded = True
+        return self._crypto
+
+    def _load_syncw_crypto(self):
+        cfg = self.get_config_parser()
+        if not cfg.has_option('store_crypt', 'key_path'):
             return None
-        key_path = self.cfg.get('store_crypt', 'key_path')
+        key_path = cfg.get('store_crypt', 'key_path')
         if not os.path.exists(key_path):
             raise InvalidConfigError('key file %s doesn\'t exist' % key_path)
 
@@ -225,15 +248,24 @@ class SyncwObjStoreFactory(object):
         self.syncwerk_cfg = cfg or SyncwerkConfig()
         self.json_cfg = None
         self.enable_storage_classes = False
+        self.repo_storage_ids = None
         self.obj_stores = {'commits': {}, 'fs': {}, 'blocks': {}}
+        self._created_stores = []
+        self._inherited_sessions = []
 
         cfg = self.syncwerk_cfg.get_config_parser()
         if cfg.has_option ('storage', 'enable_storage_classes'):
             enable_storage_classes = cfg.get('storage', 'enable_storage_classes')
             if enable_storage_classes.lower() == 'true':
-                from objectstorage.db import init_db_session_class
                 self.enable_storage_classes = True
-                self.session = init_db_session_class(cfg)
+                self.session = self._make_session_class()
+                ttl = REPO_STORAGE_ID_TTL
+                if cfg.has_option('storage', 'repo_storage_id_ttl'):
+                    try:
+                        ttl = cfg.getint('storage', 'repo_storage_id_ttl')
+                    except ValueError:
+                        raise InvalidConfigError('invalid repo_storage_id_ttl in section storage')
+                self.repo_storage_ids = RepoStorageIdMap(self.session, ttl)
                 try:
                     json_file = cfg.get('storage', 'storage_classes_file')
                     f = open(json_file)
@@ -276,8 +308,79 @@ class SyncwObjStoreFactory(object):
 
         return self.obj_stores[obj_type]
 
+    def get_cache_size(self, obj_type):
+        '''Return the size in bytes of the in-memory object cache configured
+        by the `memory_cache_size` option (in MB) of the obj_type section, or
+        0 if the cache is disabled.
+
+        '''
+        cache_size = self._get_int_option(obj_type, 'memory_cache_size', 0)
+
+        return max(cache_size, 0) * 1024 * 1024
+
+    def get_cpu_workers(self, obj_type):
+        '''Return the number of worker processes configured by the
+        `cpu_workers` option of the obj_type section, to decode and parse
+        objects of large batch loads. 0 (the default) disables them.
+
+        '''
+        return max(self._get_int_option(obj_type, 'cpu_workers', 0), 0)
+
+    def get_cpu_batch_size(self, obj_type):
+        '''Return the minimum number of objects, configured by the
+        `cpu_batch_size` option of the obj_type section, for a batch load to
+        use the worker processes.
+
+        '''
+        return max(self._get_int_option(obj_type, 'cpu_batch_size', CPU_BATCH_SIZE), 1)
+
+    def _get_int_option(self, obj_type, option, default):
+        cfg = self.syncwerk_cfg.get_config_parser()
+        try:
+            section = self.obj_section_map[obj_type]
+        except KeyError:
+            raise RuntimeError('unknown obj_type ' + obj_type)
+
+        if not cfg.has_option(section, option):
+            return default
+
+        try:
+            return cfg.getint(section, option)
+        except ValueError:
+            raise InvalidConfigError('invalid %s in section %s' % (option, section))
+
+    def reset_clients(self):
+        '''Reset the connections of all the object stores created so far, see
+        AbstractObjStore.reset_clients()
+
+        '''
+        for obj_store in self._created_stores:
+            obj_store.reset_clients()
+        for obj_stores in self.obj_stores.values():
+            for obj_store in obj_stores.values():
+                obj_store.reset_clients()
+
+        if self.repo_storage_ids is not None:
+            # Closing the pooled database connections would close them for
+            # the parent too, so they are kept unused and a new engine is
+            # created on first use.
+            self._inherited_sessions.append(self.session)
+            self.session = self._make_session_class()
+            self.repo_storage_ids.reset_clients(self.session)
+
+    def _make_session_class(self):
+        # Connecting to the database and importing sqlalchemy is slow, it's
+        # only done when a repo storage id is needed.
+        cfg = self.syncwerk_cfg.get_config_parser()
+        return LazyObject(lambda: _init_db_session_class(cfg))
+
     def get_obj_store(self, obj_type):
         '''Return an implementation of SyncwerkObjStore'''
+        obj_store = self._create_obj_store(obj_type)
+        self._created_stores.append(obj_store)
+        return obj_store
+
+    def _create_obj_store(self, obj_type):
         cfg = self.syncwerk_cfg.get_config_parser()
         try:
             section = self.obj_section_map[obj_type]
@@ -323,21 +426,164 @@ class SyncwObjStoreFactory(object):
         else:
             raise InvalidConfigError('unknown %s backend "%s"' % (obj_type, backend_name))
 
-objstore_factory = SyncwObjStoreFactory()
-repo_storage_id = {}
+def _init_db_session_class(cfg):
+    from objectstorage.db import init_db_session_class
+    return init_db_session_class(cfg)
+
+class RepoStorageIdMap(object):
+    '''The storage ids of the repos, from the RepoStorageId table.
+
+    The whole table is loaded at once. After ttl seconds, the rows added
+    since are loaded on the next lookup, and every FULL_RELOAD_TTLS times
+    the table is loaded again, to pick up the repos that were moved or
+    deleted. A lookup of a repo that isn't in the map also loads the new
+    rows, at most once every MISS_REFRESH_INTERVAL seconds, as it may have
+    been created since. Repos that are still missing after a load started
+    during their lookup use the default storage, and are remembered as such
+    until the next full reload. Rows added for them later are still loaded
+    by the ttl refreshes, and take precedence. When no load could be run
+    for the lookup, the repos use the default storage but aren't remembered.
+
+    Lookups don't lock, the refreshes are serialized by a lock.
+
+    '''
+    FULL_RELOAD_TTLS = 10
+    MISS_REFRESH_INTERVAL = 1
+
+    def __init__(self, session_class, ttl=REPO_STORAGE_ID_TTL):
+        self.session_class = session_class
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        # repo_id -> storage_id
+        self._storage_ids = None
+        # Repos without a row, since the last full reload
+        self._misses = set()
+        self._max_row_id = None
+        self._ttl_refreshed_at = 0
+        self._miss_refreshed_at = 0
+        # When the last load of rows started
+        self._loaded_at = 0
+        self._n_refreshes = 0
+
+    def reset_clients(self, session_class):
+        '''Use session_class from now on. Must be called in a forked child
+        process, with a session class that isn't shared with the parent. The
+        loaded storage ids are kept, but the lock is replaced, since another
+        thread of the parent may have held it when the process forked.
+
+        '''
+        self.session_class = session_class
+        self._lock = threading.Lock()
+
+    def get(self, repo_id):
+        '''Return the storage id of the repo, or None if it uses the default
+        storage.
+
+        '''
+        return self.get_many([repo_id])[repo_id]
+
+    def get_many(self, repo_ids):
+        '''Return a {repo_id: storage_id} dict of the repos. The storage id
+        is None for the repos using the default storage.
+
+        '''
+        now = time.time()
+        if self._storage_ids is None or now - self._ttl_refreshed_at >= self.ttl:
+            self._refresh(now, False)
+
+        storage_ids = self._storage_ids
+        misses = self._misses
+        missing = [repo_id for repo_id in repo_ids
+                   if repo_id not in storage_ids and repo_id not in misses]
+        if missing:
+            self._refresh(now, True)
+            storage_ids = self._storage_ids
+            # The refresh may not have run, and an older load doesn't prove
+            # the repos have no row.
+            if self._loaded_at >= now:
+                misses = self._misses
+                for repo_id in missing:
+                    if repo_id not in storage_ids:
+                        misses.add(repo_id)
+
+        return dict([(repo_id, storage_ids.get(repo_id)) for repo_id in repo_ids])
+
+    def _refresh(self, now, on_miss):
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock.
+            if on_miss:
+                if now - self._miss_refreshed_at < self.MISS_REFRESH_INTERVAL:
+                    return
+            elif self._storage_ids is not None and now - self._ttl_refreshed_at < self.ttl:
+                return
+
+            loaded_at = time.time()
+            # The table is reflected when the session class is created.
+            session = self.session_class()
+            try:
+                from .db import Base
+                RepoStorageId = Base.classes.RepoStorageId
+                # Rows can only be loaded incrementally if they have an
+                # increasing id.
+                row_id = getattr(RepoStorageId, 'id', None)
+
+                full = self._storage_ids is None or row_id is None or \
+                       (not on_miss and self._n_refreshes >= self.FULL_RELOAD_TTLS)
+                if full:
+                    storage_ids, max_row_id = self._load_rows(session, RepoStorageId, row_id, None)
+                else:
+                    new_ids, max_row_id = self._load_rows(session, RepoStorageId, row_id,
+                                                          self._max_row_id)
+            finally:
+                session.close()
+
+            if full:
+                # Swap the whole map, lookups in progress keep the old one.
+                self._storage_ids = storage_ids
+                self._misses = set()
+                self._max_row_id = max_row_id
+                self._n_refreshes = 0
+            else:
+                self._storage_ids.update(new_ids)
+                if max_row_id is not None:
+                    self._max_row_id = max(max_row_id, self._max_row_id)
+                if not on_miss:
+                    self._n_refreshes += 1
+            if full or not on_miss:
+                self._ttl_refreshed_at = now
+            self._miss_refreshed_at = now
+            self._loaded_at = loaded_at
+
+    def _load_rows(self, session, RepoStorageId, row_id, after_row_id):
+        '''Return the {repo_id: storage_id} dict of the rows with an id
+        greater than after_row_id, or of all rows if it is None, and their
+        max id.
+
+        '''
+        columns = [RepoStorageId.repo_id, RepoStorageId.storage_id]
+        if row_id is not None:
+            columns.append(row_id)
+        q = session.query(*columns)
+        if after_row_id is not None:
+            q = q.filter(row_id > after_row_id)
+
+        storage_ids = {}
+        max_row_id = after_row_id
+        for row in q:
+            storage_ids[row[0]] = row[1]
+            if row_id is not None and (max_row_id is None or row[2] > max_row_id):
+                max_row_id = row[2]
+
+        return storage_ids, max_row_id
+
+# Created on first use, so that importing objectstorage doesn't read the
+# config or connect to the database.
+objstore_factory = LazyObject(SyncwObjStoreFactory)
 
 def get_repo_storage_id(repo_id):
-    if repo_storage_id.has_key(repo_id):
-        return repo_storage_id[repo_id]
-    else:
-        from .db import Base
-        from sqlalchemy.orm.scoping import scoped_session
-        RepoStorageId = Base.classes.RepoStorageId
-        storage_id = None
-        session = scoped_session(objstore_factory.session)
-        q = session.query(RepoStorageId).filter(RepoStorageId.repo_id==repo_id)
-        r = q.first()
-        storage_id = r.storage_id if r else None
-        repo_storage_id[repo_id] = storage_id
-        session.remove()
-        return storage_id
+    return objstore_factory.repo_storage_ids.get(repo_id)
+
+def get_repo_storage_ids(repo_ids):
+    '''Return a {repo_id: storage_id} dict of the repos'''
+    return objstore_factory.repo_storage_ids.get_many(repo_ids)
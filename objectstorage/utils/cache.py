@@ -0,0 +1,186 @@
+#coding: UTF-8
+
+import threading
+from array import array
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''A thread-safe LRU cache bounded by the estimated size (in bytes) of
+    the cached values instead of the number of entries.
+
+    `sizeof` is called once per value when it is inserted, so it should be
+    cheap; it defaults to `len`, which is exact for plain strings.
+
+    '''
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.cur_bytes = 0
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            # Re-insert to mark the entry as most recently used.
+            self._items[key] = item
+            self._hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        '''Cache value under key. Return False if the value is too large to
+        ever fit in the cache.
+
+        '''
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.cur_bytes -= old[1]
+
+            while self._items and self.cur_bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.cur_bytes -= evicted_size
+                self._evictions += 1
+
+            self._items[key] = (value, size)
+            self.cur_bytes += size
+
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.cur_bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def hit_count(self):
+        return self._hits
+
+    def miss_count(self):
+        return self._misses
+
+    def evict_count(self):
+        return self._evictions
+
+class FrequencySketch(object):
+    '''A count-min sketch with small saturating counters, used to estimate
+    how often a key has been accessed recently. All counters are halved
+    after every `10 * capacity` increments so that old popularity fades out.
+
+    '''
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+             0x165667B19E3779F9, 0x27D4EB2F165667C5)
+    MAX_COUNT = 15
+
+    def __init__(self, capacity):
+        capacity = max(capacity, 1)
+        bits = 10
+        while (1 << bits) < capacity * 16:
+            bits += 1
+        self._shift = 64 - bits
+        self._tables = [array('B', [0]) * (1 << bits) for _ in self.SEEDS]
+        self._sample_size = 10 * capacity
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        return [((h * seed) & 0xFFFFFFFFFFFFFFFF) >> self._shift for seed in self.SEEDS]
+
+    def increment(self, key):
+        for table, idx in zip(self._tables, self._indexes(key)):
+            if table[idx] < self.MAX_COUNT:
+                table[idx] += 1
+
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+
+    def estimate(self, key):
+        return min([table[idx] for table, idx in zip(self._tables, self._indexes(key))])
+
+    def _reset(self):
+        for table in self._tables:
+            for i in xrange(len(table)):
+                table[i] >>= 1
+        self._additions //= 2
+
+class TinyLFUCache(LRUCache):
+    '''A size bounded LRU cache with a TinyLFU admission policy.
+
+    Once the cache is full, a new value is only admitted if it has been
+    requested more often than every entry it would evict, so a long run of
+    one-off keys (e.g. a large sequential download) can't flush the
+    frequently used working set.
+
+    `expected_item_size` is only used to size the frequency sketch.
+
+    '''
+    def __init__(self, max_bytes, sizeof=len, expected_item_size=1024 * 1024):
+        LRUCache.__init__(self, max_bytes, sizeof)
+        self._sketch = FrequencySketch(max_bytes // expected_item_size)
+        self._rejections = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._sketch.increment(key)
+        return LRUCache.get(self, key, default)
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.cur_bytes -= old[1]
+
+            # Find the LRU entries that would have to go to make room, and
+            # only evict them if the new key is more popular than all. Keys
+            # seen only once (e.g. part of a scan) never evict anything.
+            victims = []
+            freed = 0
+            if self.cur_bytes + size > self.max_bytes:
+                freq = self._sketch.estimate(key)
+                if freq <= 1:
+                    self._rejections += 1
+                    return False
+                for victim_key, (_, victim_size) in self._items.iteritems():
+                    if self._sketch.estimate(victim_key) >= freq:
+                        self._rejections += 1
+                        return False
+                    victims.append(victim_key)
+                    freed += victim_size
+                    if self.cur_bytes - freed + size <= self.max_bytes:
+                        break
+
+            for victim_key in victims:
+                del self._items[victim_key]
+                self._evictions += 1
+            self.cur_bytes -= freed
+
+            self._items[key] = (value, size)
+            self.cur_bytes += size
+
+        return True
+
+    def reject_count(self):
+        return self._rejections
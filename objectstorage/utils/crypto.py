@@ -1,8 +1,9 @@
 #coding: utf-8
 
+import threading
 from ctypes import (
     create_string_buffer, CDLL, c_char_p,
-    c_void_p, c_int, POINTER, byref
+    c_void_p, c_int, POINTER, byref, addressof, string_at
 )
 from ctypes.util import find_library
 from objectstorage.exceptions import SyncwCryptoException
@@ -30,12 +31,12 @@ EVP_EncryptInit_ex.argtypes = [c_void_p, c_void_p, c_void_p, c_char_p, c_char_p]
 # int EVP_EncryptUpdate(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl, const unsigned char *in, int inl);
 EVP_EncryptUpdate = dl.EVP_EncryptUpdate
 EVP_EncryptUpdate.restype = c_int
-EVP_EncryptUpdate.argtypes = [c_void_p, c_char_p, POINTER(c_int), c_char_p, c_int]
+EVP_EncryptUpdate.argtypes = [c_void_p, c_void_p, POINTER(c_int), c_char_p, c_int]
 
 # int EVP_EncryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl);
 EVP_EncryptFinal_ex = dl.EVP_EncryptFinal_ex
 EVP_EncryptFinal_ex.restype = c_int
-EVP_EncryptFinal_ex.argtypes = [c_void_p, c_char_p, POINTER(c_int)]
+EVP_EncryptFinal_ex.argtypes = [c_void_p, c_void_p, POINTER(c_int)]
 
 # int EVP_DecryptInit_ex(EVP_CIPHER_CTX *ctx, const EVP_CIPHER *type, ENGINE *impl, unsigned char *key, unsigned char *iv);
 EVP_DecryptInit_ex = dl.EVP_DecryptInit_ex
@@ -45,77 +46,205 @@ EVP_DecryptInit_ex.argtypes = [c_void_p, c_void_p, c_void_p, c_char_p, c_char_p]
 # int EVP_DecryptUpdate(EVP_CIPHER_CTX *ctx, unsigned char *out, int *outl, unsigned char *in, int inl);
 EVP_DecryptUpdate = dl.EVP_DecryptUpdate
 EVP_DecryptUpdate.restype = c_int
-EVP_DecryptUpdate.argtypes = [c_void_p, c_char_p, POINTER(c_int), c_char_p, c_int]
+EVP_DecryptUpdate.argtypes = [c_void_p, c_void_p, POINTER(c_int), c_char_p, c_int]
 
 # int EVP_DecryptFinal_ex(EVP_CIPHER_CTX *ctx, unsigned char *outm, int *outl);
 EVP_DecryptFinal_ex = dl.EVP_DecryptFinal_ex
 EVP_DecryptFinal_ex.restype = c_int
-EVP_DecryptFinal_ex.argtypes = [c_void_p, c_char_p, POINTER(c_int)]
+EVP_DecryptFinal_ex.argtypes = [c_void_p, c_void_p, POINTER(c_int)]
+
+# int EVP_CIPHER_CTX_set_padding(EVP_CIPHER_CTX *x, int padding);
+EVP_CIPHER_CTX_set_padding = dl.EVP_CIPHER_CTX_set_padding
+EVP_CIPHER_CTX_set_padding.restype = c_int
+EVP_CIPHER_CTX_set_padding.argtypes = [c_void_p, c_int]
 
 #  void EVP_CIPHER_CTX_free(EVP_CIPHER_CTX *ctx);
 EVP_CIPHER_CTX_free = dl.EVP_CIPHER_CTX_free
 EVP_CIPHER_CTX_free.restype = None
 EVP_CIPHER_CTX_free.argtypes = [c_void_p]
 
+class CipherCtx(object):
+    '''Owns an EVP_CIPHER_CTX, which is freed with the object'''
+    def __init__(self):
+        self.ctx = EVP_CIPHER_CTX_new()
+        if not self.ctx:
+            raise SyncwCryptoException('Failed to create cipher ctx')
+
+    def __del__(self, free=EVP_CIPHER_CTX_free):
+        if self.ctx:
+            free(self.ctx)
+            self.ctx = None
+
 class SyncwCrypto(object):
+    '''AES-256-CBC encryption of objects.
+
+    Each thread reuses its own cipher contexts and output buffer, instead
+    of creating them for every call. Output buffers larger than
+    MAX_KEPT_BUFFER are not kept, and up to MAX_KEPT_STREAM_CTXS contexts
+    of finished SyncwDecryptors are kept.
+
+    '''
+    # AES block size
+    BLOCK_SIZE = 16
+    MAX_KEPT_BUFFER = 16 * 1024 * 1024
+    MAX_KEPT_STREAM_CTXS = 4
+
     def __init__(self, key, iv):
         self.key = key
         self.iv = iv
+        self._local = threading.local()
+
+    def _get_ctx(self, name):
+        ctx = getattr(self._local, name, None)
+        if ctx is None:
+            ctx = CipherCtx()
+            setattr(self._local, name, ctx)
+        return ctx.ctx
+
+    def _get_out_buffer(self, size):
+        buf = getattr(self._local, 'out_buffer', None)
+        if buf is not None and len(buf) >= size:
+            return buf
+
+        if buf is not None:
+            # Grow geometrically, to not reallocate for every larger object
+            size = max(size, min(2 * len(buf), self.MAX_KEPT_BUFFER))
+        buf = create_string_buffer(size)
+        if size <= self.MAX_KEPT_BUFFER:
+            self._local.out_buffer = buf
+        return buf
 
     def enc_data(self, data):
         if not data:
             raise SyncwCryptoException('Invalid encrypted data')
 
-        ctx = EVP_CIPHER_CTX_new()
-        if not ctx:
-            raise SyncwCryptoException('Failed to create cipher ctx')
-
-        try:
-            if EVP_EncryptInit_ex(ctx, EVP_aes_256_cbc(), None,
-                                  self.key, self.iv) == 0:
-                raise SyncwCryptoException('Failed to init cipher ctx')
+        ctx = self._get_ctx('enc_ctx')
+        if EVP_EncryptInit_ex(ctx, EVP_aes_256_cbc(), None,
+                              self.key, self.iv) == 0:
+            raise SyncwCryptoException('Failed to init cipher ctx')
 
-            out = create_string_buffer(len(data) + 16)
-            out_len = c_int(0)
-            if EVP_EncryptUpdate(ctx, out, byref(out_len),
-                                 data, len(data)) == 0:
-                raise SyncwCryptoException('Failed to encrypt update')
+        out = self._get_out_buffer(len(data) + self.BLOCK_SIZE)
+        out_addr = addressof(out)
+        out_len = c_int(0)
+        if EVP_EncryptUpdate(ctx, out_addr, byref(out_len),
+                             data, len(data)) == 0:
+            raise SyncwCryptoException('Failed to encrypt update')
 
-            out_final = create_string_buffer(16)
-            out_final_len = c_int(0)
-            if EVP_EncryptFinal_ex(ctx, out_final,
-                                   byref(out_final_len)) == 0:
-                raise SyncwCryptoException('Failed to encrypt final')
+        n = out_len.value
+        if EVP_EncryptFinal_ex(ctx, out_addr + n, byref(out_len)) == 0:
+            raise SyncwCryptoException('Failed to encrypt final')
 
-            return out.raw[:out_len.value] + out_final.raw[:out_final_len.value]
-        finally:
-            EVP_CIPHER_CTX_free(ctx)
+        return string_at(out_addr, n + out_len.value)
 
     def dec_data(self, data):
         if not data or len(data) % 16 != 0:
             raise SyncwCryptoException('Invalid decrypted data')
 
-        ctx = EVP_CIPHER_CTX_new()
-        if not ctx:
-            raise SyncwCryptoException('Failed to create cipher ctx')
+        return self._decrypt(data, self.iv, True)
+
+    def dec_blocks(self, data, iv):
+        '''Decrypt whole cipher blocks taken from the middle of encrypted
+        data. In CBC mode, iv must be the cipher block preceding data, or
+        the original iv if data starts at the beginning. Padding is not
+        removed.
+
+        '''
+        if not data or len(data) % self.BLOCK_SIZE != 0:
+            raise SyncwCryptoException('Invalid decrypted data')
 
-        try:
-            if EVP_DecryptInit_ex(ctx, EVP_aes_256_cbc(), None,
-                                  self.key, self.iv) == 0:
-                raise SyncwCryptoException('Failed to init cipher ctx')
-
-            out = create_string_buffer(len(data))
-            out_len = c_int(0)
-            if EVP_DecryptUpdate(ctx, out, byref(out_len),
-                                 data, len(data)) == 0:
-                raise SyncwCryptoException('Failed to decrypt update')
-
-            out_final = create_string_buffer(16)
-            out_final_len = c_int(0)
-            if EVP_DecryptFinal_ex(ctx, out_final,
-                                   byref(out_final_len)) == 0:
+        return self._decrypt(data, iv, False)
+
+    def _decrypt(self, data, iv, padding):
+        ctx = self._get_ctx('dec_ctx')
+        if EVP_DecryptInit_ex(ctx, EVP_aes_256_cbc(), None,
+                              self.key, iv) == 0:
+            raise SyncwCryptoException('Failed to init cipher ctx')
+        EVP_CIPHER_CTX_set_padding(ctx, 1 if padding else 0)
+
+        # The decrypted data is never longer than the input, and
+        # DecryptUpdate holds back the last block when padding is on, so
+        # the final block fits in the same buffer.
+        out = self._get_out_buffer(len(data) + self.BLOCK_SIZE)
+        out_addr = addressof(out)
+        out_len = c_int(0)
+        if EVP_DecryptUpdate(ctx, out_addr, byref(out_len),
+                             data, len(data)) == 0:
+            raise SyncwCryptoException('Failed to decrypt update')
+
+        n = out_len.value
+        if padding:
+            if EVP_DecryptFinal_ex(ctx, out_addr + n, byref(out_len)) == 0:
                 raise SyncwCryptoException('Failed to decrypt final')
+            n += out_len.value
+
+        return string_at(out_addr, n)
+
+    def decryptor(self):
+        '''Return a SyncwDecryptor, to decrypt an object piece by piece'''
+        return SyncwDecryptor(self)
+
+    def _acquire_stream_ctx(self):
+        # A decryptor keeps its context until final(), and several
+        # decryptors may be in use at once, so they don't share dec_ctx.
+        ctxs = getattr(self._local, 'stream_ctxs', None)
+        if ctxs:
+            return ctxs.pop()
+        return CipherCtx()
+
+    def _release_stream_ctx(self, ctx):
+        ctxs = getattr(self._local, 'stream_ctxs', None)
+        if ctxs is None:
+            ctxs = self._local.stream_ctxs = []
+        if len(ctxs) < self.MAX_KEPT_STREAM_CTXS:
+            ctxs.append(ctx)
+
+    def unpad(self, data):
+        '''Strip the PKCS#7 padding from the decrypted last cipher blocks'''
+        pad = ord(data[-1]) if data else 0
+        if pad < 1 or pad > self.BLOCK_SIZE or len(data) < pad:
+            raise SyncwCryptoException('Invalid padding in decrypted data')
+        return data[:-pad]
+
+class SyncwDecryptor(object):
+    '''Incremental decryption of an object encrypted by SyncwCrypto. Feed
+    the encrypted data in pieces of any size to update(), then call
+    final(). Each call returns the data decrypted so far.
+
+    '''
+    BLOCK_SIZE = SyncwCrypto.BLOCK_SIZE
+
+    def __init__(self, crypto):
+        self._crypto = crypto
+        self._ctx = crypto._acquire_stream_ctx()
+        if EVP_DecryptInit_ex(self._ctx.ctx, EVP_aes_256_cbc(), None,
+                              crypto.key, crypto.iv) == 0:
+            raise SyncwCryptoException('Failed to init cipher ctx')
+        EVP_CIPHER_CTX_set_padding(self._ctx.ctx, 1)
+        self._in_len = 0
+
+    def update(self, data):
+        if not data:
+            return ''
+        self._in_len += len(data)
+
+        # The output is copied before returning, so the output buffer of
+        # the thread can be used.
+        out = self._crypto._get_out_buffer(len(data) + self.BLOCK_SIZE)
+        out_len = c_int(0)
+        if EVP_DecryptUpdate(self._ctx.ctx, addressof(out), byref(out_len),
+                             data, len(data)) == 0:
+            raise SyncwCryptoException('Failed to decrypt update')
+        return string_at(addressof(out), out_len.value)
+
+    def final(self):
+        if self._in_len == 0 or self._in_len % self.BLOCK_SIZE != 0:
+            raise SyncwCryptoException('Invalid decrypted data')
+
+        out = self._crypto._get_out_buffer(self.BLOCK_SIZE)
+        out_len = c_int(0)
+        if EVP_DecryptFinal_ex(self._ctx.ctx, addressof(out), byref(out_len)) == 0:
+            raise SyncwCryptoException('Failed to decrypt final')
 
-            return out.raw[:out_len.value] + out_final.raw[:out_final_len.value]
-        finally:
-            EVP_CIPHER_CTX_free(ctx)
+        ctx, self._ctx = self._ctx, None
+        self._crypto._release_stream_ctx(ctx)
+        return string_at(addressof(out), out_len.value)
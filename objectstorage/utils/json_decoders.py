@@ -0,0 +1,66 @@
+#coding: UTF-8
+
+'''Registry of the json decoders used to parse fs and commit objects.
+
+The registered decoder with the highest priority is used: ujson if it's
+installed, or else the standard json module. A decoder must return the
+same objects as json.loads, in particular strings as unicode. Integers may
+be returned as long where json.loads returns int (ujson does so for values
+above 2**31), they compare and serialize the same.
+
+tests/test_json_decoders.py checks the registered decoders against json.
+
+'''
+
+import json
+
+# name -> (priority, loads)
+_decoders = {}
+_forced_name = None
+_current = None
+
+def register_decoder(name, loads, priority=0):
+    _decoders[name] = (priority, loads)
+    _select_decoder()
+
+def use_decoder(name):
+    '''Always use the decoder registered as name, or, if name is None, the
+    one with the highest priority.
+
+    '''
+    global _forced_name
+    if name is not None and name not in _decoders:
+        raise ValueError('unknown json decoder %s' % name)
+    _forced_name = name
+    _select_decoder()
+
+def get_decoder_name():
+    return _current[0]
+
+def _select_decoder():
+    global _current
+    if _forced_name is not None:
+        name = _forced_name
+    else:
+        name = max(_decoders, key=lambda name: _decoders[name][0])
+    _current = (name, _decoders[name][1])
+
+def loads(data):
+    name, decode = _current
+    try:
+        return decode(data)
+    except ValueError:
+        if name == 'json':
+            raise
+        # Third party decoders may reject valid json the standard module
+        # accepts (e.g. very large integers), let it decide.
+        return json.loads(data)
+
+register_decoder('json', json.loads)
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register_decoder('ujson', lambda data: ujson.loads(data, precise_float=True), priority=10)
@@ -0,0 +1,37 @@
+#coding: UTF-8
+
+import threading
+
+class LazyObject(object):
+    '''A proxy to the object returned by factory(), which is only called
+    when an attribute of the proxy is first used.
+
+    '''
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_obj', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get_obj(self):
+        obj = self._obj
+        if obj is None:
+            with self._lock:
+                if self._obj is None:
+                    object.__setattr__(self, '_obj', self._factory())
+                obj = self._obj
+        return obj
+
+    def __getattr__(self, name):
+        obj = self._obj
+        if obj is None:
+            obj = self._get_obj()
+        return getattr(obj, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_obj(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._get_obj(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._get_obj()(*args, **kwargs)
@@ -0,0 +1,47 @@
+#coding: UTF-8
+
+import os
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+
+class SharedThreadPool(object):
+    '''A ThreadPool that is only started on first use.
+
+    Worker threads don't survive a fork, so a new pool is started when it's
+    used from a process other than the one that created it.
+
+    '''
+    def __init__(self, size):
+        self.size = size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pool is None or self._pid != pid:
+            with self._lock:
+                if self._pool is None or self._pid != pid:
+                    self._pool = self._create_pool()
+                    self._pid = pid
+        return self._pool
+
+    def _create_pool(self):
+        return ThreadPool(self.size)
+
+    def apply_async(self, func, args=()):
+        return self.get().apply_async(func, args)
+
+class SharedProcessPool(SharedThreadPool):
+    '''A process Pool that is only started on first use, and restarted
+    in a forked process. initializer(*initargs) is called by each worker
+    process when it starts.
+
+    '''
+    def __init__(self, size, initializer=None, initargs=()):
+        SharedThreadPool.__init__(self, size)
+        self.initializer = initializer
+        self.initargs = initargs
+
+    def _create_pool(self):
+        return Pool(self.size, self.initializer, self.initargs)
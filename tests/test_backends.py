@@ -0,0 +1,203 @@
+#coding: UTF-8
+
+'''Tests of the object reads of AbstractObjStore, on a filesystem store in
+a temporary dir.
+
+'''
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from objectstorage.backends.base import decompress_chunks
+from objectstorage.backends.filesystem import SyncwObjStoreFS
+from objectstorage.utils.crypto import SyncwCrypto
+
+REPO_ID = 'f' * 36
+
+def make_crypto(rng):
+    key = ''.join(chr(rng.randint(0, 255)) for _ in range(32))
+    iv = ''.join(chr(rng.randint(0, 255)) for _ in range(16))
+    return SyncwCrypto(key, iv)
+
+def random_data(rng, size):
+    return ''.join(chr(rng.randint(0, 255)) for _ in range(size))
+
+class ObjStoreTestBase(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(7)
+        self.obj_dir = tempfile.mkdtemp()
+        self.n_objs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.obj_dir)
+
+    def make_store(self, encrypted, compressed=False):
+        crypto = make_crypto(self.rng) if encrypted else None
+        return SyncwObjStoreFS(compressed, self.obj_dir, crypto)
+
+    def write_obj(self, store, content, version=1):
+        '''Write content as it is stored, and return the object id'''
+        data = content
+        if store.compressed and version == 1:
+            data = zlib.compress(data)
+        if store.crypto:
+            data = store.crypto.enc_data(data)
+        self.n_objs += 1
+        obj_id = '%040x' % self.n_objs
+        store.write_obj(data, REPO_ID, obj_id)
+        return obj_id
+
+class ReadObjRangeTest(ObjStoreTestBase):
+    # Sizes around the cipher block size, and some random ones
+    SIZES = [1, 2, 15, 16, 17, 31, 32, 33, 47, 48, 49, 100, 255, 256, 257, 1000, 4096]
+
+    def record_raw_ranges(self, store):
+        ranges = []
+        read_obj_raw_range = store.read_obj_raw_range
+        def recording_read(repo_id, version, obj_id, offset, length):
+            ranges.append((offset, length))
+            return read_obj_raw_range(repo_id, version, obj_id, offset, length)
+        store.read_obj_raw_range = recording_read
+        return ranges
+
+    def check_ranges(self, store, version=1):
+        sizes = self.SIZES + [self.rng.randint(1, 10000) for _ in range(10)]
+        if not store.crypto:
+            # Empty objects can't be encrypted
+            sizes.append(0)
+
+        for size in sizes:
+            content = random_data(self.rng, size)
+            obj_id = self.write_obj(store, content, version)
+            self.assertEqual(store.read_obj(REPO_ID, version, obj_id), content)
+            self.assertEqual(store.get_obj_size(REPO_ID, version, obj_id), size)
+
+            ranges = [(offset, length) for offset in range(0, min(size, 40) + 20)
+                      for length in (0, 1, 15, 16, 17, 32, 33)]
+            # Ranges crossing the last blocks, and past the end
+            ranges += [(size - back, length) for back in range(1, min(size, 40) + 1)
+                       for length in (1, 15, 16, 17, 50)]
+            ranges += [(self.rng.randint(0, size + 40), self.rng.randint(-1, size + 40))
+                       for _ in range(100)]
+            for offset, length in ranges:
+                expected = content[offset:offset+max(length, 0)]
+                self.assertEqual(store.read_obj_range(REPO_ID, version, obj_id, offset, length),
+                                 expected, (size, offset, length))
+
+    def test_plain(self):
+        self.check_ranges(self.make_store(False))
+
+    def test_encrypted(self):
+        self.check_ranges(self.make_store(True))
+
+    def test_compressed(self):
+        self.check_ranges(self.make_store(False, compressed=True))
+        self.check_ranges(self.make_store(True, compressed=True))
+        # Only v1 objects are compressed
+        self.check_ranges(self.make_store(True, compressed=True), version=0)
+
+    def test_encrypted_fetched_range(self):
+        store = self.make_store(True)
+        bs = store.crypto.BLOCK_SIZE
+        content = random_data(self.rng, 10 * bs + 5)
+        obj_id = self.write_obj(store, content)
+        ranges = self.record_raw_ranges(store)
+
+        # The previous cipher block is the iv, and one more block is read
+        # after the range.
+        self.assertEqual(store.read_obj_range(REPO_ID, 1, obj_id, 3 * bs + 2, bs),
+                         content[3 * bs + 2:4 * bs + 2])
+        self.assertEqual(ranges.pop(), (2 * bs, 4 * bs))
+
+        # The first block uses the iv of the store
+        self.assertEqual(store.read_obj_range(REPO_ID, 1, obj_id, 0, 5), content[:5])
+        self.assertEqual(ranges.pop(), (0, 2 * bs))
+
+        # The size only needs the last block, and the one before it
+        self.assertEqual(store.get_obj_size(REPO_ID, 1, obj_id), len(content))
+        self.assertEqual(ranges.pop(), (9 * bs, 3 * bs))
+
+class ReadObjStreamTest(ObjStoreTestBase):
+    def split(self, data, n):
+        '''data in chunks of n bytes'''
+        return [data[i:i+n] for i in range(0, len(data), n)]
+
+    def decompress(self, chunks, chunk_size):
+        out = list(decompress_chunks(chunks, chunk_size))
+        for data in out:
+            self.assertTrue(0 < len(data) <= chunk_size)
+        return ''.join(out)
+
+    def test_decompress_split_at_every_byte(self):
+        content = random_data(self.rng, 300) + 'a' * 3000
+        compressed = zlib.compress(content)
+        for i in range(len(compressed) + 1):
+            for chunk_size in (1, 7, 4096):
+                self.assertEqual(self.decompress([compressed[:i], compressed[i:]], chunk_size),
+                                 content, (i, chunk_size))
+        self.assertEqual(self.decompress(self.split(compressed, 1), 100), content)
+
+    def test_decompress_empty(self):
+        self.assertEqual(self.decompress([zlib.compress('')], 10), '')
+        self.assertEqual(self.decompress(self.split(zlib.compress(''), 1), 10), '')
+
+    def test_decompress_trailing_garbage(self):
+        # Ignored, like zlib.decompress does
+        content = random_data(self.rng, 1000)
+        data = zlib.compress(content) + 'garbage'
+        self.assertEqual(zlib.decompress(data), content)
+        for n in (1, 5, 100, len(data)):
+            self.assertEqual(self.decompress(self.split(data, n), 64), content)
+        self.assertEqual(self.decompress([zlib.compress(content), 'more', 'chunks'], 64),
+                         content)
+
+    def test_decompress_truncated(self):
+        compressed = zlib.compress(random_data(self.rng, 1000))
+        for i in (0, 1, 2, len(compressed) // 2, len(compressed) - 1):
+            self.assertRaises(zlib.error, zlib.decompress, compressed[:i])
+            self.assertRaises(zlib.error, self.decompress, self.split(compressed[:i], 3), 64)
+        self.assertRaises(zlib.error, self.decompress, ['not zlib'], 64)
+
+    def check_stream(self, store, content, version=1):
+        obj_id = self.write_obj(store, content, version)
+        self.assertEqual(store.read_obj(REPO_ID, version, obj_id), content)
+        for chunk_size in (1, 15, 16, 17, 100, 4096):
+            chunks = list(store.read_obj_stream(REPO_ID, version, obj_id, chunk_size))
+            self.assertEqual(''.join(chunks), content, chunk_size)
+            if store.compressed and version == 1:
+                # The decompressed chunks are bounded by chunk_size
+                for data in chunks:
+                    self.assertTrue(0 < len(data) <= chunk_size)
+
+    def test_stream(self):
+        for encrypted in (False, True):
+            for compressed in (False, True):
+                store = self.make_store(encrypted, compressed)
+                for size in (1, 15, 16, 17, 1000, 5000):
+                    # Partly compressible
+                    content = random_data(self.rng, size // 2) + 'x' * (size - size // 2)
+                    self.check_stream(store, content)
+                    self.check_stream(store, content, version=0)
+
+    def test_stream_empty(self):
+        self.check_stream(self.make_store(False), '')
+        self.check_stream(self.make_store(False, compressed=True), '')
+        # Compressed, the empty object isn't empty once encrypted
+        self.check_stream(self.make_store(True, compressed=True), '')
+
+    def test_stream_fs_object(self):
+        # An encrypted and compressed fs object, as stored by the server
+        store = self.make_store(True, compressed=True)
+        dirents = [{'name': 'file%d' % i, 'id': '%040x' % i, 'mode': 0100644,
+                    'mtime': 1, 'size': i} for i in range(200)]
+        content = json.dumps({'version': 1, 'type': 3, 'dirents': dirents})
+        obj_id = self.write_obj(store, content)
+        for chunk_size in (1, 16, 1000):
+            data = ''.join(store.read_obj_stream(REPO_ID, 1, obj_id, chunk_size))
+            self.assertEqual(data, content)
+            self.assertEqual(json.loads(data)['dirents'], dirents)
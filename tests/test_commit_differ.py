@@ -0,0 +1,249 @@
+#coding: UTF-8
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import stat
+import tempfile
+import unittest
+import zlib
+
+from objectstorage import fs_mgr
+from objectstorage.backends.filesystem import SyncwObjStoreFS
+from objectstorage.commit_differ import CommitDiffer, DiffEntry, make_path, \
+    normalize_paths, ZERO_OBJ_ID
+from objectstorage.objstore_factory import objstore_factory
+
+REPO_ID = 'r' * 36
+
+class NormalizePathsTest(unittest.TestCase):
+    def test_whole_tree(self):
+        self.assertIsNone(normalize_paths(None))
+        self.assertIsNone(normalize_paths([]))
+        self.assertIsNone(normalize_paths(['/docs', '/']))
+        self.assertIsNone(normalize_paths(['']))
+
+    def test_normalize(self):
+        self.assertEqual(normalize_paths('docs/'), ['/docs'])
+        self.assertEqual(normalize_paths([u'/d\xe9j\xe0', '/docs', 'docs']),
+                         ['/docs', '/d\xc3\xa9j\xc3\xa0'])
+
+    def test_nested_paths(self):
+        self.assertEqual(normalize_paths(['/docs/2018', '/docs', '/docs/2018/a']), ['/docs'])
+
+    def test_sibling_with_same_prefix(self):
+        # '/docs-old' sorts between '/docs' and '/docs/2018' as strings
+        self.assertEqual(normalize_paths(['/docs', '/docs-old', '/docs/2018']),
+                         ['/docs', '/docs-old'])
+        self.assertEqual(normalize_paths(['/docs-old/a', '/docs/a/b', '/docs', '/docs-old']),
+                         ['/docs', '/docs-old'])
+        self.assertEqual(normalize_paths(['/a/b', '/a.b/c', '/a']), ['/a', '/a.b/c'])
+
+def reference_diff(root1, root2, handle_rename=False, fold_dirs=False):
+    '''CommitDiffer.diff() as it was before the merge-join and the level
+    traversal, except that the entries of the compared dirs are taken in
+    name order instead of dict order, like the merge-join does.
+
+    '''
+    added_files, deleted_files, added_dirs, deleted_dirs = [], [], [], []
+    modified_files, renamed_files, moved_files, renamed_dirs, moved_dirs = [], [], [], [], []
+    if root1 == root2:
+        return (added_files, deleted_files, added_dirs, deleted_dirs, modified_files,
+                renamed_files, moved_files, renamed_dirs, moved_dirs)
+
+    def load(dir_id):
+        return fs_mgr.load_syncwdir(REPO_ID, 1, dir_id)
+    def by_name(dents):
+        return sorted(dents, key=lambda dent: dent.name)
+
+    new_dirs = []
+    del_dirs = []
+    queued_dirs = [('/', root1, root2)]
+    while queued_dirs:
+        path, old_id, new_id = queued_dirs.pop(0)
+        dir1 = load(old_id)
+        dir2 = load(new_id)
+        # Names of dir2 found in dir1, instead of removing them from dir2
+        matched = set()
+
+        for dent in by_name(dir1.get_files_list()):
+            new_dent = dir2.lookup_dent(dent.name)
+            if not new_dent or new_dent.type != dent.type:
+                deleted_files.append(DiffEntry(make_path(path, dent.name), dent.id, dent.size))
+            else:
+                matched.add(dent.name)
+                if new_dent.id != dent.id:
+                    modified_files.append(DiffEntry(make_path(path, dent.name), new_dent.id,
+                                                    new_dent.size))
+        added_files.extend([DiffEntry(make_path(path, dent.name), dent.id, dent.size)
+                            for dent in by_name(dir2.get_files_list())
+                            if dent.name not in matched])
+
+        for dent in by_name(dir1.get_subdirs_list()):
+            new_dent = dir2.lookup_dent(dent.name)
+            if not new_dent or new_dent.type != dent.type:
+                del_dirs.append(DiffEntry(make_path(path, dent.name), dent.id))
+            else:
+                matched.add(dent.name)
+                if new_dent.id != dent.id:
+                    queued_dirs.append((make_path(path, dent.name), dent.id, new_dent.id))
+        new_dirs.extend([DiffEntry(make_path(path, dent.name), dent.id)
+                         for dent in by_name(dir2.get_subdirs_list())
+                         if dent.name not in matched])
+
+    if fold_dirs:
+        added_dirs = new_dirs
+        deleted_dirs = del_dirs
+    else:
+        for dirs, dir_changes, file_changes in ((new_dirs, added_dirs, added_files),
+                                                (del_dirs, deleted_dirs, deleted_files)):
+            while dirs:
+                dir_dent = dirs.pop(0)
+                dir_changes.append(DiffEntry(dir_dent.path, dir_dent.obj_id))
+                d = load(dir_dent.obj_id)
+                file_changes.extend([DiffEntry(make_path(dir_dent.path, dent.name), dent.id, dent.size)
+                                     for dent in d.get_files_list()])
+                dirs.extend([DiffEntry(make_path(dir_dent.path, dent.name), dent.id)
+                             for dent in d.get_subdirs_list()])
+
+    if handle_rename:
+        added_files, deleted_files = reference_renames(added_files, deleted_files,
+                                                       renamed_files, moved_files)
+        added_dirs, deleted_dirs = reference_renames(added_dirs, deleted_dirs,
+                                                     renamed_dirs, moved_dirs)
+
+    return (added_files, deleted_files, added_dirs, deleted_dirs, modified_files,
+            renamed_files, moved_files, renamed_dirs, moved_dirs)
+
+def reference_renames(added, deleted, renamed, moved):
+    ret_added = []
+    del_dict = {}
+    for de in deleted:
+        if de.obj_id != ZERO_OBJ_ID:
+            del_dict[de.obj_id] = de
+
+    for de in added:
+        if de.obj_id in del_dict:
+            del_de = del_dict.pop(de.obj_id)
+            if os.path.dirname(de.path) == os.path.dirname(del_de.path):
+                renamed.append(DiffEntry(del_de.path, de.obj_id, de.size, de.path))
+            else:
+                moved.append(DiffEntry(del_de.path, de.obj_id, de.size, de.path))
+        else:
+            ret_added.append(de)
+
+    ret_deleted = del_dict.values()
+    ret_deleted.extend([de for de in deleted if de.obj_id == ZERO_OBJ_ID])
+    return ret_added, ret_deleted
+
+def entries(result):
+    return [[(e.path, e.new_path, e.obj_id, e.size) for e in changes] for changes in result]
+
+class DiffParityTest(unittest.TestCase):
+    '''Compare CommitDiffer with reference_diff() on random pairs of trees,
+    stored in a filesystem store in a temporary dir. The objectstorage
+    managers use it, so the test is skipped if they were already set up
+    by another test.
+
+    '''
+    N_PAIRS = 30
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conf_dir = None
+        if objstore_factory._obj is not None:
+            return
+        cls.conf_dir = tempfile.mkdtemp()
+        os.environ['SYNCWERK_CONF_DIR'] = cls.conf_dir
+        open(os.path.join(cls.conf_dir, 'server.conf'), 'w').close()
+        cls.fs_store = SyncwObjStoreFS(True, os.path.join(cls.conf_dir, 'storage', 'fs'))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.conf_dir is not None:
+            shutil.rmtree(cls.conf_dir)
+
+    def setUp(self):
+        if self.conf_dir is None:
+            self.skipTest('objectstorage is already set up by another test')
+        self.rng = random.Random(3)
+        # Few distinct files, so that there are many renames and moves
+        self.file_ids = [self.put_file('content %d' % i) for i in range(6)] + [ZERO_OBJ_ID]
+
+    def put_obj(self, obj):
+        data = json.dumps(obj)
+        obj_id = hashlib.sha1(data).hexdigest()
+        self.fs_store.write_obj(zlib.compress(data), REPO_ID, obj_id)
+        return obj_id
+
+    def put_file(self, content):
+        return self.put_obj({'version': 1, 'type': 1, 'size': len(content),
+                             'block_ids': [hashlib.sha1(content).hexdigest()]})
+
+    def put_dir(self, tree):
+        '''Store a {name: file_id or subtree} tree, return its dir id'''
+        dirents = []
+        for name, value in tree.iteritems():
+            if isinstance(value, dict):
+                dirents.append({'name': name, 'id': self.put_dir(value), 'mode': stat.S_IFDIR,
+                                'mtime': 1})
+            else:
+                dirents.append({'name': name, 'id': value, 'mode': stat.S_IFREG | 0644,
+                                'mtime': 1, 'size': 10})
+        return self.put_obj({'version': 1, 'type': 3, 'dirents': dirents})
+
+    def random_tree(self, depth):
+        rng = self.rng
+        tree = {}
+        for _ in range(rng.randint(0, 6)):
+            tree['f%d' % rng.randint(0, 30)] = rng.choice(self.file_ids)
+        if depth > 0:
+            for _ in range(rng.randint(0, 4)):
+                tree['d%d' % rng.randint(0, 30)] = self.random_tree(depth - 1)
+        return tree
+
+    def mutate(self, tree, p=0.2):
+        '''Delete, modify, rename and add random entries of tree'''
+        rng = self.rng
+        ret = {}
+        for name, value in tree.iteritems():
+            r = rng.random()
+            if r < p:
+                continue
+            if isinstance(value, dict):
+                if rng.random() < 0.7:
+                    value = self.mutate(value, p)
+            elif r < 2 * p:
+                value = rng.choice(self.file_ids)
+            if rng.random() < p / 2:
+                name += '-renamed'
+            ret[name] = value
+        for _ in range(rng.randint(0, 2)):
+            if rng.random() < 0.5:
+                ret['new%d' % rng.randint(0, 9)] = rng.choice(self.file_ids)
+            else:
+                ret['new%d' % rng.randint(0, 9)] = self.random_tree(2)
+        return ret
+
+    def test_parity(self):
+        n_changes = 0
+        for _ in range(self.N_PAIRS):
+            tree1 = self.random_tree(4)
+            tree2 = self.mutate(tree1)
+            root1 = self.put_dir(tree1)
+            root2 = self.put_dir(tree2)
+            for options in ({}, {'fold_dirs': True}, {'handle_rename': True},
+                            {'handle_rename': True, 'fold_dirs': True}):
+                expected = entries(reference_diff(root1, root2, **options))
+                n_changes += sum(map(len, expected))
+                for parallel in (False, True):
+                    result = CommitDiffer(REPO_ID, 1, root1, root2, parallel=parallel,
+                                          batch_size=3, **options).diff()
+                    self.assertEqual(entries(result), expected, (options, parallel))
+        # The trees do differ
+        self.assertGreater(n_changes, 10 * self.N_PAIRS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#coding: UTF-8
+
+import copy
+import json
+import pickle
+import unittest
+
+from objectstorage.commits import SyncwCommit
+
+COMMIT = {
+    'commit_id': 'a' * 40,
+    'root_id': 'b' * 40,
+    'parent_id': None,
+    'version': 1,
+    'description': u'Added "caf\xe9.txt"',
+    'unknown_key': 'x',
+}
+
+class SyncwCommitTest(unittest.TestCase):
+    def test_attributes(self):
+        commit = SyncwCommit(COMMIT)
+        self.assertEqual(commit.root_id, 'b' * 40)
+        self.assertIsNone(commit.parent_id)
+        self.assertEqual(commit.unknown_key, 'x')
+        self.assertEqual(commit.get_version(), 1)
+        self.assertFalse(getattr(commit, 'encrypted', False))
+        self.assertRaises(AttributeError, getattr, commit, 'repo_id')
+        self.assertRaises(AttributeError, getattr, commit, 'no_such_key')
+        self.assertEqual(SyncwCommit().get_version(), 0)
+
+    def test_set_attributes(self):
+        commit = SyncwCommit(COMMIT)
+        commit.root_id = 'c' * 40
+        commit.encrypted = 'true'
+        commit.unknown_key = 'y'
+        commit.some_attr = [1, 2]
+        self.assertEqual(commit.root_id, 'c' * 40)
+        self.assertEqual(commit.encrypted, 'true')
+        self.assertEqual(commit.unknown_key, 'y')
+        self.assertEqual(commit.some_attr, [1, 2])
+        self.assertEqual(commit._dict['some_attr'], [1, 2])
+        self.assertEqual(commit._dict['root_id'], 'c' * 40)
+
+        del commit.some_attr
+        del commit.encrypted
+        self.assertRaises(AttributeError, getattr, commit, 'some_attr')
+        self.assertFalse(getattr(commit, 'encrypted', False))
+        self.assertNotIn('some_attr', commit._dict)
+
+        commit = SyncwCommit()
+        commit.some_attr = 1
+        self.assertEqual(commit.some_attr, 1)
+        self.assertEqual(commit._dict, {'some_attr': 1})
+
+    def test_read_only_dict(self):
+        commit = SyncwCommit(COMMIT)
+        d = commit._dict
+        self.assertEqual(d, COMMIT)
+        self.assertEqual(json.loads(json.dumps(d)), COMMIT)
+        self.assertRaises(TypeError, d.__setitem__, 'root_id', 'c' * 40)
+        self.assertRaises(TypeError, d.update, {'root_id': 'c' * 40})
+        self.assertRaises(TypeError, d.pop, 'root_id')
+        self.assertEqual(commit.root_id, 'b' * 40)
+
+        d = dict(commit._dict)
+        d['root_id'] = 'c' * 40
+        self.assertEqual(commit.root_id, 'b' * 40)
+
+    def test_set_dict(self):
+        commit = SyncwCommit(COMMIT)
+        commit._dict = {'root_id': 'c' * 40, 'other_key': 1}
+        self.assertEqual(commit._dict, {'root_id': 'c' * 40, 'other_key': 1})
+        self.assertRaises(AttributeError, getattr, commit, 'commit_id')
+        self.assertRaises(AttributeError, getattr, commit, 'unknown_key')
+
+    def test_copy(self):
+        commit = SyncwCommit(COMMIT)
+        commit.some_attr = 1
+        for copied in (pickle.loads(pickle.dumps(commit, 2)), copy.copy(commit),
+                       copy.deepcopy(commit)):
+            self.assertEqual(copied._dict, commit._dict)
+        self.assertEqual(pickle.loads(pickle.dumps(commit._dict)), commit._dict)
+        self.assertEqual(copy.copy(commit._dict), commit._dict)
+
+if __name__ == '__main__':
+    unittest.main()
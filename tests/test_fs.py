@@ -0,0 +1,57 @@
+#coding: UTF-8
+
+import json
+import unittest
+
+from objectstorage.fs import SyncwDir, SyncwDirent
+
+def make_dir(ret_unicode=False):
+    entries = json.loads(json.dumps([
+        {'name': 'a', 'id': '1' * 40, 'mode': 0100644, 'mtime': 1, 'size': 10},
+        {'name': 'b', 'id': '2' * 40, 'mode': 040000, 'mtime': 2, 'size': 0},
+        {'name': 'c', 'id': '3' * 40, 'mode': 0100644, 'mtime': 3, 'size': 30},
+    ]))
+    return SyncwDir.from_json_entries('repo', 1, '0' * 40, entries, ret_unicode)
+
+class SyncwDirTest(unittest.TestCase):
+    def names(self, dents):
+        return sorted(dent.name for dent in dents)
+
+    def test_remove_entry(self):
+        d = make_dir()
+        self.assertEqual(self.names(d.get_files_list()), ['a', 'c'])
+        self.assertEqual(self.names(d.get_subdirs_list()), ['b'])
+        self.assertEqual(self.names(d.get_sorted_dirents()), ['a', 'b', 'c'])
+
+        d.remove_entry('a')
+        d.remove_entry('b')
+        d.remove_entry('missing')
+        self.assertEqual(self.names(d.get_files_list()), ['c'])
+        self.assertEqual(d.get_subdirs_list(), [])
+        self.assertEqual(self.names(d.get_sorted_dirents()), ['c'])
+        self.assertIsNone(d.lookup_dent('a'))
+
+    def test_copy(self):
+        d = make_dir(ret_unicode=True)
+        d.get_files_list()
+        c = d.copy()
+        c.remove_entry(u'a')
+        self.assertEqual(self.names(c.get_files_list()), [u'c'])
+        self.assertEqual(self.names(d.get_files_list()), [u'a', u'c'])
+        self.assertEqual(d.lookup_dent(u'a').type, SyncwDirent.FILE)
+
+    def test_shared_dir_is_read_only(self):
+        # As marked by SyncwFSManager when it caches the dir
+        d = make_dir()
+        d._shared = True
+        self.assertRaises(RuntimeError, d.remove_entry, 'a')
+        self.assertRaises(RuntimeError, setattr, d, 'dirents', {})
+        self.assertEqual(self.names(d.get_sorted_dirents()), ['a', 'b', 'c'])
+
+        c = d.copy()
+        c.remove_entry('a')
+        self.assertEqual(self.names(c.get_sorted_dirents()), ['b', 'c'])
+        self.assertEqual(self.names(d.get_sorted_dirents()), ['a', 'b', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#coding: UTF-8
+
+'''Check that every registered json decoder returns the same objects as the
+standard json module when parsing fs and commit objects. No storage backend
+is needed:
+
+    python -m unittest discover -s tests
+
+'''
+
+import json
+import random
+import unittest
+
+from objectstorage.utils import json_decoders
+from objectstorage.fs import SyncwDir, BlockList, dirents_from_json
+from objectstorage.commits import SyncwCommit
+
+NAME_CHARS = u'abc\xe9中 "\\/\n\t'
+
+def typed(obj):
+    '''obj with the type of every value next to it, so that e.g. u'a' and
+    'a', or 1 and 1.0, don't compare equal. int and long are the same
+    python 2 integer type, and ujson returns long for values that fit in an
+    int.
+
+    '''
+    if isinstance(obj, dict):
+        return (dict, sorted((typed(k), typed(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, (list, tuple)):
+        return (type(obj), [typed(v) for v in obj])
+    if isinstance(obj, (int, long)) and not isinstance(obj, bool):
+        return (long, obj)
+    return (type(obj), obj)
+
+def random_name(rng):
+    return u''.join(rng.choice(NAME_CHARS) for _ in range(rng.randint(1, 12)))
+
+def random_id(rng):
+    return '%040x' % rng.getrandbits(160)
+
+def dump(obj, rng):
+    data = json.dumps(obj, ensure_ascii=rng.random() < 0.5)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return data
+
+def make_dir(rng):
+    dirents = [{
+        'name': random_name(rng),
+        'id': random_id(rng),
+        'mode': rng.choice([0100644, 040000, 0120777]),
+        'mtime': rng.randint(0, 2**40),
+        'size': rng.randint(0, 2**40),
+    } for _ in range(rng.randint(0, 40))]
+    return dump({'version': 1, 'type': 3, 'dirents': dirents}, rng)
+
+def make_file(rng):
+    block_ids = [random_id(rng) for _ in range(rng.randint(0, 20))]
+    return dump({'version': 1, 'type': 1, 'block_ids': block_ids,
+                 'size': rng.randint(0, 2**50)}, rng)
+
+def make_commit(rng):
+    return dump({
+        'commit_id': random_id(rng),
+        'root_id': random_id(rng),
+        'parent_id': random_id(rng),
+        'second_parent_id': None,
+        'description': random_name(rng),
+        'creator_name': random_name(rng) + u'@example.com',
+        'ctime': rng.randint(0, 2**40),
+        'version': 1,
+        'encrypted': 'true',
+        'enc_version': 2,
+        'no_local_history': False,
+        'unknown_field': random_name(rng),
+        'float': 0.1,
+    }, rng)
+
+class JsonDecodersTest(unittest.TestCase):
+    N_OBJECTS = 30
+
+    def tearDown(self):
+        json_decoders.use_decoder(None)
+
+    def get_decoder_names(self):
+        names = sorted(json_decoders._decoders)
+        if names == ['json']:
+            self.skipTest('no third party json decoder installed')
+        return names
+
+    def parse_all(self, parse, make):
+        '''{decoder name: [typed(parse(data)) for random objects]}'''
+        results = {}
+        for name in self.get_decoder_names():
+            json_decoders.use_decoder(name)
+            rng = random.Random(1)
+            results[name] = [typed(parse(make(rng))) for _ in range(self.N_OBJECTS)]
+        return results
+
+    def assert_same_as_json(self, results):
+        for name, result in results.iteritems():
+            for expected, got in zip(results['json'], result):
+                self.assertEqual(expected, got, 'decoder %s differs from json' % name)
+
+    def test_loads(self):
+        for make in (make_dir, make_file, make_commit):
+            self.assert_same_as_json(self.parse_all(json_decoders.loads, make))
+
+    def test_dirents(self):
+        for ret_unicode in (False, True):
+            def parse(data):
+                entries = json_decoders.loads(data)['dirents']
+                dirents = dirents_from_json(entries, 'dir', ret_unicode)
+                return [(k, d.name, d.id, d.type, d.mtime, d.size)
+                        for k, d in dirents.iteritems()]
+            self.assert_same_as_json(self.parse_all(parse, make_dir))
+
+    def test_lazy_dir(self):
+        for ret_unicode in (False, True):
+            def parse(data):
+                entries = json_decoders.loads(data)['dirents']
+                d = SyncwDir.from_json_entries('repo', 1, 'dir', entries, ret_unicode)
+                return [(dent.name, dent.id, dent.type) for dent in d.get_files_list()] + \
+                    [(dent.name, dent.id, dent.type) for dent in d.get_subdirs_list()]
+            self.assert_same_as_json(self.parse_all(parse, make_dir))
+
+    def test_blocks(self):
+        def parse(data):
+            d = json_decoders.loads(data)
+            return list(BlockList.from_hex(d['block_ids'])), d['size']
+        self.assert_same_as_json(self.parse_all(parse, make_file))
+
+    def test_commit(self):
+        # Same as SyncwCommitManager.parse_commit(), which needs a backend.
+        # make_commit() avoids values ujson rejects, so it parses them all.
+        for ret_unicode in (False, True):
+            def parse(data):
+                commit = SyncwCommit()
+                commit._set_fields(json_decoders.loads(data), not ret_unicode)
+                return commit._dict
+            self.assert_same_as_json(self.parse_all(parse, make_commit))
+
+    def test_fallback_to_json(self):
+        for name in self.get_decoder_names():
+            json_decoders.use_decoder(name)
+            self.assertEqual(json_decoders.loads('[%d]' % 2**70), [2**70])
+            self.assertRaises(ValueError, json_decoders.loads, '{"a": ')
+
+    def test_use_decoder(self):
+        json_decoders.use_decoder('json')
+        self.assertEqual(json_decoders.get_decoder_name(), 'json')
+        self.assertRaises(ValueError, json_decoders.use_decoder, 'no-such-decoder')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#coding: UTF-8
+
+'''Tests of the repo storage ids, on a sqlite database. They are skipped if
+sqlalchemy isn't installed.
+
+'''
+
+import os
+import shutil
+import signal
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    import sqlalchemy
+    import sqlalchemy.event
+except ImportError:
+    sqlalchemy = None
+
+from objectstorage import objstore_factory as factory_module
+from objectstorage.objstore_factory import SyncwerkConfig, SyncwObjStoreFactory, \
+    RepoStorageIdMap
+
+SERVER_CONF = '''[storage]
+enable_storage_classes = true
+storage_classes_file = %s
+'''
+
+@unittest.skipIf(sqlalchemy is None, 'sqlalchemy is not installed')
+class RepoStorageIdsTestBase(unittest.TestCase):
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+        self.old_conf_dir = os.environ.get('SYNCWERK_CONF_DIR')
+        os.environ['SYNCWERK_CONF_DIR'] = self.conf_dir
+
+        classes_file = os.path.join(self.conf_dir, 'storage_classes.json')
+        with open(classes_file, 'w') as f:
+            f.write('[]')
+        with open(os.path.join(self.conf_dir, 'server.conf'), 'w') as f:
+            f.write(SERVER_CONF % classes_file)
+
+        self.db = sqlite3.connect(os.path.join(self.conf_dir, 'syncwerk.db'))
+        self.db.execute('CREATE TABLE RepoStorageId (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'repo_id CHAR(40) NOT NULL UNIQUE, storage_id VARCHAR(255) NOT NULL)')
+        self.add_rows([('repo%d' % i, 'storage1') for i in range(10)])
+
+    def tearDown(self):
+        self.db.close()
+        if self.old_conf_dir is None:
+            del os.environ['SYNCWERK_CONF_DIR']
+        else:
+            os.environ['SYNCWERK_CONF_DIR'] = self.old_conf_dir
+        shutil.rmtree(self.conf_dir)
+
+    def add_rows(self, rows):
+        self.db.executemany('INSERT INTO RepoStorageId (repo_id, storage_id) VALUES (?, ?)', rows)
+        self.db.commit()
+
+    def set_storage_id(self, repo_id, storage_id):
+        self.db.execute('UPDATE RepoStorageId SET storage_id = ? WHERE repo_id = ?',
+                        (storage_id, repo_id))
+        self.db.commit()
+
+    def make_factory(self):
+        return SyncwObjStoreFactory(SyncwerkConfig())
+
+class RepoStorageIdMapTest(RepoStorageIdsTestBase):
+    '''Simulated lookups, with a fake clock'''
+    TTL = 60
+
+    def setUp(self):
+        RepoStorageIdsTestBase.setUp(self)
+        self.clock = 1000.0
+        self.real_time = factory_module.time.time
+        factory_module.time.time = lambda: self.clock
+
+        session_class = self.make_factory().session
+        self.queries = []
+        sqlalchemy.event.listen(session_class.kw['bind'], 'before_cursor_execute',
+                                self.on_query)
+        self.id_map = RepoStorageIdMap(session_class, self.TTL)
+
+    def tearDown(self):
+        factory_module.time.time = self.real_time
+        RepoStorageIdsTestBase.tearDown(self)
+
+    def on_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+    def full_loads(self):
+        return [q for q in self.queries if 'WHERE' not in q]
+
+    def test_lookup(self):
+        self.assertEqual(self.id_map.get('repo1'), 'storage1')
+        self.assertEqual(self.id_map.get_many(['repo2', 'repo3', 'default']),
+                         {'repo2': 'storage1', 'repo3': 'storage1', 'default': None})
+        self.assertEqual(len(self.full_loads()), 1)
+
+    def test_new_repo_after_load(self):
+        self.assertEqual(self.id_map.get('repo1'), 'storage1')
+        # Created right after the map was loaded: no load can be run for
+        # the lookup yet, but the repo isn't remembered as missing.
+        self.add_rows([('new', 'storage2')])
+        self.clock += 0.5
+        self.assertIsNone(self.id_map.get('new'))
+        self.clock += 0.6
+        self.assertEqual(self.id_map.get('new'), 'storage2')
+
+    def test_new_repo(self):
+        self.assertEqual(self.id_map.get('repo1'), 'storage1')
+        self.clock += 2
+        self.add_rows([('new', 'storage2')])
+        self.assertEqual(self.id_map.get('new'), 'storage2')
+
+    def test_misses(self):
+        self.assertIsNone(self.id_map.get('default'))
+        self.clock += 2
+        self.assertIsNone(self.id_map.get('default'))
+        n_queries = len(self.queries)
+        # Remembered as missing, until the ttl refreshes
+        for i in range(100):
+            self.clock += 0.5
+            self.assertIsNone(self.id_map.get('default'))
+        self.assertEqual(len(self.queries), n_queries)
+
+        # A row added later is loaded by the ttl refresh
+        self.add_rows([('default', 'storage2')])
+        self.assertIsNone(self.id_map.get('default'))
+        self.clock += self.TTL
+        self.assertEqual(self.id_map.get('default'), 'storage2')
+
+    def test_refresh_under_misses(self):
+        self.assertEqual(self.id_map.get('repo1'), 'storage1')
+        self.set_storage_id('repo1', 'storage2')
+        # 33 minutes of lookups of repos using the default storage. The
+        # misses don't delay the ttl refreshes, nor the full reloads.
+        for i in range(400):
+            self.clock += 5
+            self.assertIsNone(self.id_map.get('default%d' % (i % 20)))
+        self.assertEqual(self.id_map.get('repo1'), 'storage2')
+        # A ttl refresh every minute, a full reload every FULL_RELOAD_TTLS of
+        # them, and a load for each missing repo after the full reloads.
+        n_ttls = 400 * 5 // self.TTL
+        n_full_loads = 1 + n_ttls // (RepoStorageIdMap.FULL_RELOAD_TTLS + 1)
+        self.assertEqual(len(self.full_loads()), n_full_loads)
+        self.assertLessEqual(len(self.queries), n_ttls + 20 * n_full_loads)
+
+class ResetClientsTest(RepoStorageIdsTestBase):
+    def test_reset_clients(self):
+        factory = self.make_factory()
+        id_map = factory.repo_storage_ids
+        self.assertEqual(id_map.get('repo1'), 'storage1')
+        session_class = factory.session
+        engine = session_class.kw['bind']
+        lock = id_map._lock
+
+        factory.reset_clients()
+        self.assertIs(factory.repo_storage_ids, id_map)
+        self.assertIs(id_map.session_class, factory.session)
+        self.assertIsNot(id_map._lock, lock)
+        # The inherited engine is kept, but not used
+        self.assertIn(session_class, factory._inherited_sessions)
+        self.assertIsNot(factory.session.kw['bind'], engine)
+
+        self.add_rows([('new', 'storage2')])
+        id_map._miss_refreshed_at = 0
+        self.assertEqual(id_map.get('new'), 'storage2')
+        self.assertEqual(id_map.get('repo1'), 'storage1')
+
+    def test_forked_child(self):
+        factory = self.make_factory()
+        id_map = factory.repo_storage_ids
+        self.assertEqual(id_map.get('repo1'), 'storage1')
+        self.add_rows([('new', 'storage2')])
+        id_map._miss_refreshed_at = 0
+
+        # Another thread holds the lock when the process forks
+        id_map._lock.acquire()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.alarm(10)
+                    factory.reset_clients()
+                    if id_map.get('new') == 'storage2':
+                        status = 0
+                finally:
+                    os._exit(status)
+        finally:
+            id_map._lock.release()
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(id_map.get('new'), 'storage2')
@@ -0,0 +1,96 @@
+#coding: UTF-8
+
+'''Check that importing objectstorage stays cheap: the config and the
+database are only used when the first object is accessed. Each check runs
+in a new python process.
+
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_CONF = '''[storage]
+enable_storage_classes = true
+storage_classes_file = %(conf_dir)s/storage_classes.json
+'''
+
+STORAGE_CLASSES = '''[{"storage_id": "default", "is_default": true,
+  "commits": {"backend": "fs", "dir": "%(conf_dir)s"},
+  "fs": {"backend": "fs", "dir": "%(conf_dir)s"},
+  "blocks": {"backend": "fs", "dir": "%(conf_dir)s"}}]
+'''
+
+# Record the files opened by the process
+PRELUDE = '''
+import sys, __builtin__
+opened = []
+real_open = __builtin__.open
+def recording_open(name, *args, **kwargs):
+    opened.append(name)
+    return real_open(name, *args, **kwargs)
+__builtin__.open = recording_open
+
+def conf_read():
+    return any(name.endswith('server.conf') for name in opened)
+'''
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+        values = {'conf_dir': self.conf_dir}
+        with open(os.path.join(self.conf_dir, 'server.conf'), 'w') as f:
+            f.write(SERVER_CONF % values)
+        with open(os.path.join(self.conf_dir, 'storage_classes.json'), 'w') as f:
+            f.write(STORAGE_CLASSES % values)
+
+    def tearDown(self):
+        shutil.rmtree(self.conf_dir)
+
+    def run_python(self, code):
+        env = dict(os.environ)
+        env['SYNCWERK_CONF_DIR'] = self.conf_dir
+        env.pop('SYNCWERK_CENTRAL_CONF_DIR', None)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR] + sys.path)
+        proc = subprocess.Popen([sys.executable, '-c', PRELUDE + code], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0, output)
+
+    def test_import(self):
+        self.run_python('''
+import objectstorage
+from objectstorage import fs_mgr, commit_mgr, block_mgr, CommitDiffer
+from objectstorage.objstore_factory import objstore_factory
+assert not conf_read(), opened
+assert 'sqlalchemy' not in sys.modules
+assert 'objectstorage.db' not in sys.modules
+''')
+
+    def test_first_object_access(self):
+        self.run_python('''
+import objectstorage
+from objectstorage import commit_mgr
+assert not conf_read()
+# The database is only used by the first repo storage id lookup
+commit_mgr.get_backend_name()
+assert conf_read(), opened
+assert 'sqlalchemy' not in sys.modules
+try:
+    commit_mgr.load_commit('repo', 1, '0' * 40)
+except ImportError as e:
+    # Without sqlalchemy, the database can't be used
+    assert 'sqlalchemy' in str(e), e
+except Exception:
+    assert 'objectstorage.db' in sys.modules
+else:
+    assert 'objectstorage.db' in sys.modules
+''')
+
+if __name__ == '__main__':
+    unittest.main()
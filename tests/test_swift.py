@@ -0,0 +1,102 @@
+#coding: UTF-8
+
+'''Tests of the swift backend, against a fake swift server'''
+
+import httplib
+import threading
+import unittest
+import urllib2
+from StringIO import StringIO
+
+from objectstorage.backends import swift
+from objectstorage.backends.swift import SwiftConf, SyncwObjStoreSwift
+
+STORAGE_URL = 'http://swift.local/v1/AUTH_test'
+
+class FakeResponse(StringIO):
+    def __init__(self, code, data='', headers=None):
+        StringIO.__init__(self, data)
+        self.code = code
+        self.headers = headers or {}
+
+    def getcode(self):
+        return self.code
+
+class FakeSwift(object):
+    '''Serve the v1.0 auth and object GET and HEAD requests. The token
+    expires after every expire_after object requests.
+
+    '''
+    def __init__(self, objects, expire_after):
+        self.objects = objects
+        self.expire_after = expire_after
+        self.lock = threading.Lock()
+        self.n_tokens = 0
+        self.n_auths = 0
+        self.n_requests = 0
+        self.bad_requests = []
+
+    def urlopen(self, req):
+        url = req.get_full_url()
+        if url.endswith('/auth/v1.0'):
+            with self.lock:
+                self.n_auths += 1
+                self.n_tokens += 1
+                token = 'token%d' % self.n_tokens
+            return FakeResponse(httplib.OK, headers={'x-storage-url': STORAGE_URL,
+                                                     'x-auth-token': token})
+
+        token = req.get_header('X-auth-token')
+        prefix = STORAGE_URL + '/container/'
+        with self.lock:
+            if not url.startswith(prefix) or token is None:
+                self.bad_requests.append((url, token))
+                raise urllib2.HTTPError(url, httplib.BAD_REQUEST, 'bad request', {}, None)
+            if token != 'token%d' % self.n_tokens:
+                raise urllib2.HTTPError(url, httplib.UNAUTHORIZED, 'unauthorized', {}, None)
+            self.n_requests += 1
+            if self.n_requests % self.expire_after == 0:
+                # Expire the token
+                self.n_tokens += 1
+
+        data = self.objects[url[len(prefix):]]
+        if req.get_method() == 'HEAD':
+            return FakeResponse(httplib.OK, headers={'content-length': str(len(data))})
+        return FakeResponse(httplib.OK, data)
+
+class SwiftTest(unittest.TestCase):
+    def setUp(self):
+        self.objects = dict([('repo/obj%d' % i, 'content %d' % i) for i in range(500)])
+        self.server = FakeSwift(self.objects, expire_after=50)
+        self.real_urlopen = swift.urllib2.urlopen
+        swift.urllib2.urlopen = self.server.urlopen
+
+        conf = SwiftConf('user', 'password', 'container', 'swift.local', 'v1.0',
+                         None, False, None, 'default')
+        self.store = SyncwObjStoreSwift(False, conf)
+
+    def tearDown(self):
+        swift.urllib2.urlopen = self.real_urlopen
+
+    def test_read_obj(self):
+        self.assertEqual(self.store.read_obj('repo', 1, 'obj1'), 'content 1')
+        self.assertEqual(self.store.stat_obj_raw('repo', 1, 'obj12'), len('content 12'))
+        self.assertEqual(self.server.n_auths, 1)
+
+    def test_concurrent_reauthentication(self):
+        obj_ids = ['obj%d' % i for i in range(500)]
+        for obj_id, data in self.store.read_objs('repo', 1, obj_ids, ordered=False):
+            self.assertEqual(data, self.objects['repo/' + obj_id])
+        sizes = self.store._map_concurrent(
+            lambda obj_id: self.store.stat_obj_raw('repo', 1, obj_id), obj_ids[:100], True)
+        self.assertEqual(list(sizes), [len(self.objects['repo/' + obj_id])
+                                       for obj_id in obj_ids[:100]])
+
+        self.assertEqual(self.server.bad_requests, [])
+        # One authentication per expired token, not one per thread that
+        # got rejected.
+        n_expired = 600 // 50
+        self.assertLessEqual(self.server.n_auths, n_expired + 1)
+
+if __name__ == '__main__':
+    unittest.main()